@@ -0,0 +1,220 @@
+#!/usr/bin/env python3
+
+"""
+Columnar loader for the experiment's answer location tags and participant files.
+
+Flattens Experiment/Answer_Location_Tags/*.json (one row per rect) and
+Experiment/Participants/*.json (one row per assignment) into numpy arrays.
+The result is cached in Experiment/Outputs/cache as one .npy file per column
+(opened memory-mapped), and rebuilt only when a source file changes.
+
+    import experiment_data as ed
+    tags = ed.load_tags()
+    tags['pageIndex'], tags['x'], tags.decode('paper')
+"""
+
+import os
+import glob
+import json
+import hashlib
+import re
+import numpy as np
+
+k_experimentDir = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'Experiment')
+k_cacheVersion = 2
+
+# Answer location tag files are named Paper<paper number><ttopic group>_tT<target topic number>.json
+k_tagFileRe = re.compile(r'Paper(\d+)([A-Z])_tT(\d+)\.json$')
+
+# categories shared by all tables, so that a code means the same value in every table
+k_paperCodes = ['P1', 'P2', 'P3', 'P4', 'Practice']  # same as Paper.defaultPapers in PeyeDF, code is the paper index
+k_ttopicGroups = ['A', 'B']  # TargetTopicGroup in PeyeDF
+k_categories = {'paper': k_paperCodes, 'ttopicGroup': k_ttopicGroups}
+
+k_tagColumns = [('paper', np.int16),  # categorical (k_paperCodes), code is the paper index used in participants' jsons
+                ('ttopicGroup', np.int16),  # categorical (k_ttopicGroups)
+                ('ttopicNo', np.int16),
+                ('questionNo', np.int16),
+                ('pageIndex', np.int32),
+                ('x', np.float64),
+                ('y', np.float64),
+                ('width', np.float64),
+                ('height', np.float64),
+                ('readingClass', np.int16),
+                ('classSource', np.int16),
+                ('unixt', np.int64)]  # first (earliest) unix time in ms of the rect, -1 if missing
+
+k_participantColumns = [('pNo', np.int16),
+                        ('condition', np.int16),
+                        ('order', np.int16),  # order in which the paper was given
+                        ('paper', np.int16),  # categorical (k_paperCodes), code is the paper index
+                        ('ttopicGroup', np.int16)]  # categorical (k_ttopicGroups)
+
+
+class Table(object):
+    """ Set of equal length columns (numpy arrays). Categorical columns store integer codes,
+    which index into categories[column] (the same k_categories for all tables). """
+
+    def __init__(self, columns, categories):
+        self.columns = columns
+        self.categories = categories
+
+    def __getitem__(self, name):
+        return self.columns[name]
+
+    def __len__(self):
+        return len(next(iter(self.columns.values()))) if self.columns else 0
+
+    def __repr__(self):
+        return 'Table({} rows, columns: {})'.format(len(self), ', '.join(self.columns))
+
+    def code(self, name, value):
+        """ Integer code of a categorical value (e.g. tags.code('paper', 'P1')). """
+        return self.categories[name].index(value)
+
+    def decode(self, name):
+        """ Array of the original values of a categorical column. """
+        return np.array(self.categories[name], dtype=object)[self.columns[name]]
+
+    def where(self, mask):
+        """ New table with only the rows selected by mask (boolean array or indices). """
+        return Table({k: v[mask] for k, v in self.columns.items()}, self.categories)
+
+
+# ---------------------------------------------
+# ---- parsing
+# ---------------------------------------------
+
+def _group_code(group, path):
+    if group not in k_ttopicGroups:
+        raise ValueError('Unexpected target topic group {} in {}'.format(group, path))
+    return k_ttopicGroups.index(group)
+
+
+def _parse_tags(paths):
+    rows = []
+    for path in paths:
+        match = k_tagFileRe.search(path)
+        if match is None:
+            raise ValueError('Unexpected answer location tag file name: ' + path)
+        paper = int(match.group(1)) - 1
+        group = _group_code(match.group(2), path)
+        ttopic = int(match.group(3))
+        with open(path) as f:
+            tags = json.load(f)
+        for tag in tags:
+            for rect in tag['rects']:
+                unixt = rect.get('unixt') or [-1]
+                rows.append((paper, group, ttopic, rect.get('questionNo', tag['questionNo']), rect['pageIndex'],
+                             rect['origin']['x'], rect['origin']['y'], rect['size']['width'], rect['size']['height'],
+                             rect['readingClass'], rect['classSource'], min(unixt)))
+    return rows, k_categories
+
+
+def _parse_participants(paths):
+    rows = []
+    for path in paths:
+        with open(path) as f:
+            participant = json.load(f)
+        for order, assignment in enumerate(participant['assignments']):
+            rows.append((participant['pNo'], participant['condition'], order, assignment['paper'], _group_code(assignment['ttopicGroup'], path)))
+    return rows, k_categories
+
+
+def to_columns(rows, spec):
+    if rows:
+        return {name: np.array(col, dtype=dtype) for (name, dtype), col in zip(spec, zip(*rows))}
+    return {name: np.empty(0, dtype=dtype) for name, dtype in spec}
+
+
+# ---------------------------------------------
+# ---- cache
+# ---------------------------------------------
+
+def _file_sha1(path):
+    with open(path, 'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+
+def sources_state(paths, previous=None):
+    """ mtime, size and sha1 of each source. Files whose mtime and size are unchanged since previous
+    are not hashed again. """
+    previous = previous or {}
+    state = {}
+    for path in paths:
+        st = os.stat(path)
+        name = os.path.basename(path)
+        old = previous.get(name)
+        if old is not None and old['mtime'] == st.st_mtime and old['size'] == st.st_size:
+            state[name] = old
+        else:
+            state[name] = {'mtime': st.st_mtime, 'size': st.st_size, 'sha1': _file_sha1(path)}
+    return state
+
+
+def same_contents(state_a, state_b):
+    return {k: v['sha1'] for k, v in state_a.items()} == {k: v['sha1'] for k, v in state_b.items()}
+
+
+def _cached_table(name, paths, parse, spec, cache_dir):
+    table_dir = os.path.join(cache_dir, name)
+    manifest_path = os.path.join(table_dir, 'manifest.json')
+
+    manifest = None
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+        if manifest.get('version') != k_cacheVersion:
+            manifest = None
+
+    state = sources_state(paths, manifest['sources'] if manifest else None)
+    if manifest is not None and same_contents(state, manifest['sources']):
+        if state != manifest['sources']:
+            # files were touched but not changed, remember new mtimes to avoid rehashing
+            manifest['sources'] = state
+            _write_json(manifest_path, manifest)
+        columns = {col: np.load(os.path.join(table_dir, col + '.npy'), mmap_mode='r') for col, _ in spec}
+        return Table(columns, manifest['categories'])
+
+    rows, categories = parse(paths)
+    columns = to_columns(rows, spec)
+    os.makedirs(table_dir, exist_ok=True)
+    for col, values in columns.items():
+        np.save(os.path.join(table_dir, col + '.npy'), values)
+    _write_json(manifest_path, {'version': k_cacheVersion, 'sources': state, 'categories': categories})
+    return Table(columns, categories)
+
+
+def _write_json(path, obj):
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(obj, f)
+    os.replace(tmp_path, path)
+
+
+# ---------------------------------------------
+# ---- public loaders
+# ---------------------------------------------
+
+def default_cache_dir(experiment_dir=k_experimentDir):
+    return os.path.join(experiment_dir, 'Outputs', 'cache')
+
+
+def load_tags(experiment_dir=k_experimentDir, cache_dir=None):
+    """ Table with one row per answer location rect (see k_tagColumns). """
+    paths = sorted(glob.glob(os.path.join(experiment_dir, 'Answer_Location_Tags', '*.json')))
+    return _cached_table('tags', paths, _parse_tags, k_tagColumns, cache_dir or default_cache_dir(experiment_dir))
+
+
+def load_participants(experiment_dir=k_experimentDir, cache_dir=None):
+    """ Table with one row per participant assignment (see k_participantColumns). """
+    paths = sorted(glob.glob(os.path.join(experiment_dir, 'Participants', 'P*.json')))
+    return _cached_table('participants', paths, _parse_participants, k_participantColumns, cache_dir or default_cache_dir(experiment_dir))
+
+
+# ------------------------------------------------------------------------------
+# Print a summary if started from the command line
+# ------------------------------------------------------------------------------
+if __name__ == '__main__':
+    print(load_tags())
+    print(load_participants())
@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+
+"""
+Incremental fixation heatmaps per document page.
+
+Fixation durations are summed in fixed resolution grids, one per (document, pageIndex),
+in page points with the same conventions as reading rects and answer location tags
+(origin at the bottom left of the page, so grid row 0 is the bottom of the page).
+Adding a session only touches its own fixations; sessions are remembered by id so
+that they are not added twice. Grids are persisted as one .npz per document.
+
+    store = HeatmapStore(os.path.join(ed.k_experimentDir, 'Outputs', 'heatmaps'))
+    store.add_reading_event('Bener2011_asthma.pdf', 'P01', reading_event_json)
+    store.save()
+    grid = store.smoothed('Bener2011_asthma.pdf', 0, sigma=12.)
+"""
+
+import os
+import json
+import numpy as np
+
+k_cellSize = 4.  # grid resolution in page points
+k_pageSize = (612., 842.)  # largest page size expected (width, height) in points (covers A4 and letter)
+
+
+def gaussian_matrix(n, sigma_cells):
+    """ n x n matrix applying a (truncated at 3 sigma, edge normalised) gaussian filter along one axis. """
+    idx = np.arange(n)
+    d = idx[:, None] - idx[None, :]
+    m = np.exp(-0.5 * (d / sigma_cells) ** 2)
+    m[np.abs(d) > 3 * sigma_cells] = 0.
+    return m / m.sum(axis=1, keepdims=True)
+
+
+class HeatmapStore(object):
+    """ Duration weighted fixation grids, keyed by (document, pageIndex). """
+
+    def __init__(self, cache_dir, cell_size=k_cellSize, page_size=k_pageSize):
+        self.cache_dir = cache_dir
+        self.cell_size = cell_size
+        self.shape = (int(np.ceil(page_size[1] / cell_size)), int(np.ceil(page_size[0] / cell_size)))  # rows (y), cols (x)
+        self.grids = {}  # document -> {pageIndex: grid}
+        self.sessions = {}  # document -> set of session ids already added
+        self._dirty = set()
+        self._kernels = {}
+
+    # ---------------------------------------------
+    # ---- persistence
+    # ---------------------------------------------
+
+    def _path(self, document):
+        return os.path.join(self.cache_dir, document.replace(os.sep, '_') + '.npz')
+
+    def _document(self, document):
+        """ Grids of a document, loaded from the cache on first use. """
+        if document not in self.grids:
+            self.grids[document] = {}
+            self.sessions[document] = set()
+            path = self._path(document)
+            if os.path.exists(path):
+                with np.load(path) as data:
+                    meta = json.loads(str(data['meta']))
+                    if meta['cellSize'] == self.cell_size and tuple(meta['shape']) == self.shape:
+                        self.sessions[document] = set(meta['sessions'])
+                        self.grids[document] = {int(k[5:]): data[k] for k in data.files if k.startswith('page_')}
+        return self.grids[document]
+
+    def save(self):
+        """ Writes documents changed since the last save. """
+        os.makedirs(self.cache_dir, exist_ok=True)
+        for document in self._dirty:
+            meta = {'cellSize': self.cell_size, 'shape': self.shape, 'sessions': sorted(self.sessions[document])}
+            arrays = {'page_{}'.format(p): g for p, g in self.grids[document].items()}
+            tmp_path = self._path(document) + '.tmp.npz'
+            np.savez_compressed(tmp_path, meta=json.dumps(meta), **arrays)
+            os.replace(tmp_path, self._path(document))
+        self._dirty = set()
+
+    # ---------------------------------------------
+    # ---- updates
+    # ---------------------------------------------
+
+    def add(self, document, page_index, x, y, duration, session=None):
+        """ Adds fixations (arrays of pageIndex, x, y and duration). Returns False (and adds nothing)
+        if session was already added. Fixations outside the grid are ignored. """
+        grids = self._document(document)
+        if session is not None:
+            if session in self.sessions[document]:
+                return False
+            self.sessions[document].add(session)
+
+        page_index = np.asarray(page_index)
+        col = np.floor(np.asarray(x, dtype=np.float64) / self.cell_size).astype(np.int64)
+        row = np.floor(np.asarray(y, dtype=np.float64) / self.cell_size).astype(np.int64)
+        duration = np.asarray(duration, dtype=np.float64)
+        inside = (page_index >= 0) & (row >= 0) & (row < self.shape[0]) & (col >= 0) & (col < self.shape[1])
+        page_index, row, col, duration = page_index[inside], row[inside], col[inside], duration[inside]
+
+        n_cells = self.shape[0] * self.shape[1]
+        for p in np.unique(page_index):
+            on_page = page_index == p
+            flat = np.bincount(row[on_page] * self.shape[1] + col[on_page], weights=duration[on_page], minlength=n_cells)
+            grid = grids.get(int(p))
+            if grid is None:
+                grids[int(p)] = flat.reshape(self.shape)
+            else:
+                grid += flat.reshape(self.shape)
+        self._dirty.add(document)
+        return True
+
+    def add_reading_event(self, document, session, event):
+        """ Adds the pageEyeData of a reading event (as pushed to DiMe by PeyeDF). """
+        page_data = [d for d in event.get('pageEyeData', []) if d.get('pageIndex', -1) >= 0]
+        if not page_data:
+            return self.add(document, [], [], [], [], session)
+        pages = np.concatenate([np.full(len(d['Xs']), d['pageIndex']) for d in page_data])
+        xs = np.concatenate([d['Xs'] for d in page_data])
+        ys = np.concatenate([d['Ys'] for d in page_data])
+        durations = np.concatenate([d['durations'] for d in page_data])
+        return self.add(document, pages, xs, ys, durations, session)
+
+    # ---------------------------------------------
+    # ---- queries
+    # ---------------------------------------------
+
+    def grid(self, document, page_index):
+        """ Raw (unsmoothed) grid of total fixation durations, zeros if the page has no fixations. """
+        grid = self._document(document).get(page_index)
+        return grid if grid is not None else np.zeros(self.shape)
+
+    def smoothed(self, document, page_index, sigma):
+        """ Grid smoothed by a gaussian with standard deviation sigma (in page points). """
+        key = float(sigma)
+        if key not in self._kernels:
+            s = sigma / self.cell_size
+            self._kernels[key] = (gaussian_matrix(self.shape[0], s), gaussian_matrix(self.shape[1], s))
+        ky, kx = self._kernels[key]
+        return ky @ self.grid(document, page_index) @ kx.T
+
+    def pages(self, document):
+        return sorted(self._document(document))
@@ -0,0 +1,261 @@
+#!/usr/bin/env python3
+
+"""
+Batch scoring of all participants' experiment outputs.
+
+For each participant and assigned paper, computes per question metrics from the
+answers saved by PeyeDF (Experiment/Outputs/##_<date>.json) and, when available,
+from reading events exported from DiMe (Experiment/Outputs/P##/*.json, one json
+per reading event, matched to papers by file name), by overlapping reading rects
+with the paper's answer location tags.
+
+Work is split per (participant, paper) across a process pool. Each result is
+checkpointed in Outputs/scores/P##/<paper>.json, so that an interrupted run
+can be resumed; checkpoints made with an older k_metricsVersion, or whose source
+files (answers, DiMe exports, questions, tags, participant) changed, are recomputed.
+All results are merged into Outputs/scores.csv.
+
+    ./score_experiment.py [-j processes] [--force]
+"""
+
+import os
+import sys
+import glob
+import json
+import csv
+import argparse
+import multiprocessing as mp
+import numpy as np
+
+import experiment_data as ed
+import spatial_join as sj
+
+k_metricsVersion = 2  # increase when metrics change, to invalidate checkpoints
+
+# pdf of each paper index, as in Paper.defaultPapers in PeyeDF (the practice paper is not scored)
+k_filenames = ['Bener2011_asthma.pdf',
+               'StewartEtAl2013_ClinicalPsychology.pdf',
+               'HardcastleEtAl2012_Motivational.pdf',
+               'Rose2012_Placebo.pdf']
+k_papers = list(zip(ed.k_paperCodes, k_filenames))  # (code, filename) by paper index
+
+k_readClasses = [20, 30, 40]  # ReadingClass low ("read"), medium ("critical") and high, not foundString (25)
+k_eyeSource = 3  # ClassSource.eye
+
+k_fields = ['pNo', 'condition', 'order', 'paper', 'ttopicGroup', 'ttopicNo', 'questionNo', 'summary',
+            'attempts', 'correct', 'timePassed', 'answerArea', 'readFraction', 'eyeReadFraction']
+
+
+# ---------------------------------------------
+# ---- loading (in workers)
+# ---------------------------------------------
+
+def answers_pattern(pNo):
+    """ Glob pattern of the answer files of participant pNo, as named by AnswerSaver.writeOut
+    (participant number without "P", then date).
+
+    >>> import fnmatch
+    >>> fnmatch.fnmatch('01_19-10-2026_10.00.00.json', answers_pattern(1))
+    True
+    >>> fnmatch.fnmatch('11_19-10-2026_10.00.00.json', answers_pattern(1))
+    False
+    """
+    return '{:02d}_*.json'.format(pNo)
+
+
+def load_answers(outputs_dir, pNo, paper_code):
+    """ All answers given by participant pNo for the given paper, from all of their output files. """
+    answers = []
+    for path in sorted(glob.glob(os.path.join(outputs_dir, answers_pattern(pNo)))):
+        with open(path) as f:
+            output = json.load(f)
+        if output.get('pNo', pNo) != pNo:
+            continue
+        answers.extend(a for a in output['answers'] if a['paperCode'] == paper_code)
+    return answers
+
+
+def load_reading(outputs_dir, pNo, filename):
+    """ Reading rects of all reading events of participant pNo on the given pdf. """
+    events = []
+    for path in sorted(glob.glob(os.path.join(outputs_dir, 'P{:02d}'.format(pNo), '*.json'))):
+        with open(path) as f:
+            event = json.load(f)
+        if event.get('targettedResource', {}).get('uri', '').endswith(filename):
+            events.append(event)
+    if not events:
+        return None
+    return sj.load_reading_rects({'pageRects': [rect for event in events for rect in event.get('pageRects', [])]})
+
+
+def read_fraction(tags, reading, mask):
+    """ Fraction of each tag rect's area covered by the reading rects selected by mask. """
+    if reading is None:
+        return np.full(len(tags), np.nan)
+    reading = reading.where(mask)
+    index = sj.RectIndex(tags['pageIndex'], tags['x'], tags['y'], tags['width'], tags['height'])
+    _, tag_rows, area = index.join(reading['pageIndex'], reading['x'], reading['y'], reading['width'], reading['height'])
+    tag_area = tags['width'] * tags['height']
+    # reading rects may overlap each other, so the covered area is at most the tag's area
+    return np.minimum(sj.overlap_per_indexed(len(tags), tag_rows, area), tag_area) / tag_area
+
+
+# ---------------------------------------------
+# ---- scoring
+# ---------------------------------------------
+
+def score(task):
+    """ Per question metrics for one participant's paper. Runs in a worker process. """
+    experiment_dir, participant, order = task
+    assignment = participant['assignments'][order]
+    pNo = participant['pNo']
+    paper_code, filename = k_papers[assignment['paper']]
+    group = assignment['ttopicGroup']
+    outputs_dir = os.path.join(experiment_dir, 'Outputs')
+
+    with open(os.path.join(experiment_dir, 'Questions', '{}_{}.json'.format(paper_code, group))) as f:
+        questions = json.load(f)
+
+    all_tags = ed.load_tags(experiment_dir)
+    tags = all_tags.where((all_tags['paper'] == assignment['paper']) & (all_tags['ttopicGroup'] == all_tags.code('ttopicGroup', group)))
+    reading = load_reading(outputs_dir, pNo, filename)
+    if reading is not None:
+        is_read = np.isin(reading['readingClass'], k_readClasses)
+        read = read_fraction(tags, reading, is_read)
+        eye_read = read_fraction(tags, reading, is_read & (reading['classSource'] == k_eyeSource))
+    else:
+        read = eye_read = np.full(len(tags), np.nan)
+    tag_area = tags['width'] * tags['height']
+
+    answers = load_answers(outputs_dir, pNo, paper_code)
+    rows = []
+    for ttopicNo, ttopic in enumerate(questions['ttopics']):
+        for questionNo, question in enumerate(ttopic['questions']):
+            given = [a for a in answers if a['ttopicNo'] == ttopicNo and a['questionNo'] == questionNo]
+            # answer location tag files number target topics from 1
+            in_q = (tags['ttopicNo'] == ttopicNo + 1) & (tags['questionNo'] == questionNo)
+            q_area = tag_area[in_q].sum()
+            rows.append({'pNo': pNo, 'condition': participant['condition'], 'order': order,
+                         'paper': paper_code, 'ttopicGroup': group, 'ttopicNo': ttopicNo, 'questionNo': questionNo,
+                         'summary': question['summary'],
+                         'attempts': len(given),
+                         'correct': given[-1]['correct'] if given else None,
+                         'timePassed': sum(a['timePassed'] for a in given) if given else None,
+                         'answerArea': float(q_area),
+                         'readFraction': _weighted(read[in_q], tag_area[in_q]),
+                         'eyeReadFraction': _weighted(eye_read[in_q], tag_area[in_q])})
+    return pNo, paper_code, rows
+
+
+def _weighted(fractions, areas):
+    if not len(areas) or np.isnan(fractions).any():
+        return None
+    return float((fractions * areas).sum() / areas.sum())
+
+
+def checkpoint_path(experiment_dir, pNo, paper_code):
+    return os.path.join(experiment_dir, 'Outputs', 'scores', 'P{:02d}'.format(pNo), paper_code + '.json')
+
+
+def task_sources(experiment_dir, participant_path, participant, order):
+    """ Paths of the files a task's rows are computed from, by kind. """
+    assignment = participant['assignments'][order]
+    pNo = participant['pNo']
+    paper_code = k_papers[assignment['paper']][0]
+    group = assignment['ttopicGroup']
+    outputs_dir = os.path.join(experiment_dir, 'Outputs')
+    return {'participant': [participant_path],
+            'answers': sorted(glob.glob(os.path.join(outputs_dir, answers_pattern(pNo)))),
+            'reading': sorted(glob.glob(os.path.join(outputs_dir, 'P{:02d}'.format(pNo), '*.json'))),
+            'questions': [os.path.join(experiment_dir, 'Questions', '{}_{}.json'.format(paper_code, group))],
+            'tags': sorted(glob.glob(os.path.join(experiment_dir, 'Answer_Location_Tags',
+                                                  'Paper{}{}_tT*.json'.format(assignment['paper'] + 1, group))))}
+
+
+def sources_state(sources, previous=None):
+    previous = previous or {}
+    return {kind: ed.sources_state(paths, previous.get(kind)) for kind, paths in sources.items()}
+
+
+def load_checkpoint(path, sources):
+    """ Rows of a checkpoint, None if missing, made with another k_metricsVersion or if sources changed. """
+    try:
+        with open(path) as f:
+            checkpoint = json.load(f)
+    except (IOError, ValueError):
+        return None
+    if checkpoint.get('version') != k_metricsVersion or 'sources' not in checkpoint:
+        return None
+    state = sources_state(sources, checkpoint['sources'])
+    if set(state) != set(checkpoint['sources']) or \
+            not all(ed.same_contents(state[kind], checkpoint['sources'][kind]) for kind in state):
+        return None
+    return checkpoint['rows']
+
+
+def save_checkpoint(path, rows, state):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + '.tmp', 'w') as f:
+        json.dump({'version': k_metricsVersion, 'sources': state, 'rows': rows}, f)
+    os.replace(path + '.tmp', path)
+
+
+def score_all(experiment_dir=ed.k_experimentDir, n_processes=None, force=False):
+    """ Scores all participants, reusing checkpoints unless force is set. Returns all rows. """
+    participants = []
+    for path in sorted(glob.glob(os.path.join(experiment_dir, 'Participants', 'P*.json'))):
+        with open(path) as f:
+            participants.append((path, json.load(f)))
+
+    # build tags cache once here, so that workers only read it
+    ed.load_tags(experiment_dir)
+
+    results = {}
+    tasks = []
+    states = {}
+    for participant_path, participant in participants:
+        for order, assignment in enumerate(participant['assignments']):
+            key = (participant['pNo'], k_papers[assignment['paper']][0])
+            sources = task_sources(experiment_dir, participant_path, participant, order)
+            rows = None if force else load_checkpoint(checkpoint_path(experiment_dir, *key), sources)
+            if rows is None:
+                # state before scoring, so that files changed meanwhile are scored again next time
+                states[key] = sources_state(sources)
+                tasks.append((experiment_dir, participant, order))
+            else:
+                results[key] = rows
+
+    print('{} papers to score ({} from checkpoints)'.format(len(tasks), len(results)))
+    if tasks:
+        with mp.Pool(n_processes) as pool:
+            for done, (pNo, paper_code, rows) in enumerate(pool.imap_unordered(score, tasks), 1):
+                save_checkpoint(checkpoint_path(experiment_dir, pNo, paper_code), rows, states[(pNo, paper_code)])
+                results[(pNo, paper_code)] = rows
+                sys.stdout.write('\rScored {}/{} (P{:02d} {})'.format(done, len(tasks), pNo, paper_code))
+                sys.stdout.flush()
+        print('')
+
+    return [row for key in sorted(results) for row in results[key]]
+
+
+def write_csv(rows, path):
+    with open(path, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=k_fields)
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+# ------------------------------------------------------------------------------
+# Run if started from the command line
+# ------------------------------------------------------------------------------
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Score all participants of the experiment.')
+    parser.add_argument('-j', '--processes', type=int, default=None, help='number of worker processes (default: number of cores)')
+    parser.add_argument('--force', action='store_true', help='ignore checkpoints and re-score everything')
+    parser.add_argument('--experiment', default=ed.k_experimentDir, help='experiment folder')
+    args = parser.parse_args()
+
+    rows = score_all(args.experiment, args.processes, args.force)
+    out_path = os.path.join(args.experiment, 'Outputs', 'scores.csv')
+    write_csv(rows, out_path)
+    print('Written {} rows to {}'.format(len(rows), out_path))
@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+
+"""
+Bulk overlap joins between reading rects and answer location rects.
+
+Rects are given as numpy columns (page key, x, y, width, height), as loaded by
+experiment_data.load_tags or load_reading_rects below. Within each page, the
+indexed rects are sorted by their lower y, so that candidates for each query rect
+are found with a binary search (sweep on y) and filtered on x and y in bulk.
+
+    import experiment_data as ed, spatial_join as sj
+    tags = ed.load_tags()
+    p1 = tags.where(tags['paper'] == tags.code('paper', 'P1'))
+    reading = sj.load_reading_rects('reading_event.json')
+    index = sj.RectIndex(p1['pageIndex'], p1['x'], p1['y'], p1['width'], p1['height'])
+    reading_i, tag_i, area = index.join(reading['pageIndex'], reading['x'], reading['y'], reading['width'], reading['height'])
+"""
+
+import json
+import numpy as np
+
+from experiment_data import Table, to_columns
+
+k_maxPairsPerChunk = 1 << 22  # limits memory used by candidate pairs (a few tens of MB)
+
+k_readingColumns = [('pageIndex', np.int32),
+                    ('x', np.float64),
+                    ('y', np.float64),
+                    ('width', np.float64),
+                    ('height', np.float64),
+                    ('readingClass', np.int16),
+                    ('classSource', np.int16),
+                    ('unixt', np.int64)]
+
+
+class RectIndex(object):
+    """ Index of rects, grouped by an integer key (normally pageIndex). """
+
+    def __init__(self, key, x, y, width, height):
+        key = np.asarray(key)
+        y = np.asarray(y, dtype=np.float64)
+        order = np.lexsort((y, key))
+        self.order = order  # position in sorted arrays -> original row
+        self.key = key[order]
+        self.x0 = np.asarray(x, dtype=np.float64)[order]
+        self.y0 = y[order]
+        self.x1 = self.x0 + np.asarray(width, dtype=np.float64)[order]
+        self.y1 = self.y0 + np.asarray(height, dtype=np.float64)[order]
+
+        # start / end of each key's block in the sorted arrays, and tallest rect in it
+        self.keys, self.starts = np.unique(self.key, return_index=True)
+        self.ends = np.append(self.starts[1:], len(self.key))
+        self.max_height = np.array([(self.y1[s:e] - self.y0[s:e]).max() for s, e in zip(self.starts, self.ends)])
+
+    def __len__(self):
+        return len(self.key)
+
+    def join(self, key, x, y, width, height, min_area=0.):
+        """ Finds all (query, indexed) pairs of rects with the same key that overlap by more than min_area.
+        Returns three arrays: query row, indexed row (as originally passed to the constructor), overlap area. """
+        key = np.asarray(key)
+        qx0 = np.asarray(x, dtype=np.float64)
+        qy0 = np.asarray(y, dtype=np.float64)
+        qx1 = qx0 + np.asarray(width, dtype=np.float64)
+        qy1 = qy0 + np.asarray(height, dtype=np.float64)
+
+        out_q, out_i, out_area = [], [], []
+        for k in np.intersect1d(np.unique(key), self.keys):
+            b = np.searchsorted(self.keys, k)
+            start, end = self.starts[b], self.ends[b]
+            rows = np.flatnonzero(key == k)
+            # indexed rects can only overlap if their lower y is in (query y0 - tallest, query y1)
+            iy0 = self.y0[start:end]
+            lo = np.searchsorted(iy0, qy0[rows] - self.max_height[b], side='right') + start
+            hi = np.searchsorted(iy0, qy1[rows], side='left') + start
+            for q, i in self._pairs(rows, lo, hi):
+                w = np.minimum(qx1[q], self.x1[i]) - np.maximum(qx0[q], self.x0[i])
+                h = np.minimum(qy1[q], self.y1[i]) - np.maximum(qy0[q], self.y0[i])
+                area = np.where((w > 0) & (h > 0), w * h, 0.)
+                keep = area > min_area
+                out_q.append(q[keep])
+                out_i.append(self.order[i[keep]])
+                out_area.append(area[keep])
+
+        if not out_q:
+            return np.empty(0, dtype=np.intp), np.empty(0, dtype=np.intp), np.empty(0)
+        return np.concatenate(out_q), np.concatenate(out_i), np.concatenate(out_area)
+
+    @staticmethod
+    def _pairs(rows, lo, hi):
+        """ Expands candidate ranges [lo, hi) of each query row into (query, index) pairs, in chunks. """
+        counts = np.maximum(hi - lo, 0)
+        cum = np.cumsum(counts)
+        chunk_start = 0
+        while chunk_start < len(rows):
+            base = cum[chunk_start - 1] if chunk_start else 0
+            chunk_end = max(np.searchsorted(cum, base + k_maxPairsPerChunk, side='right'), chunk_start + 1)
+            c = counts[chunk_start:chunk_end]
+            total = c.sum()
+            if total:
+                offsets = np.arange(total) - np.repeat(np.cumsum(c) - c, c)
+                yield np.repeat(rows[chunk_start:chunk_end], c), np.repeat(lo[chunk_start:chunk_end], c) + offsets
+            chunk_start = chunk_end
+
+
+def overlap_per_indexed(n_indexed, indexed_rows, area):
+    """ Total overlapped area for each indexed rect (e.g. how much of each answer rect was read). """
+    return np.bincount(indexed_rows, weights=area, minlength=n_indexed)
+
+
+def load_reading_rects(path_or_event):
+    """ Table with one row per rect in a reading event (a json file or already parsed dict, with a
+    pageRects list) or in a list of tags (with rects lists, as in Answer_Location_Tags). """
+    if isinstance(path_or_event, str):
+        with open(path_or_event) as f:
+            path_or_event = json.load(f)
+    if isinstance(path_or_event, dict):
+        rects = path_or_event.get('pageRects', [])
+    else:
+        rects = [rect for tag in path_or_event for rect in tag['rects']]
+
+    rows = [(rect['pageIndex'], rect['origin']['x'], rect['origin']['y'], rect['size']['width'], rect['size']['height'],
+             rect['readingClass'], rect['classSource'], min(rect.get('unixt') or [-1])) for rect in rects]
+    return Table(to_columns(rows, k_readingColumns), {})
@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+
+"""
+Cached word and line geometry of pdfs, to map fixations to text in bulk.
+
+Word and line bounding boxes are extracted once per pdf (requires pdfminer.six) and
+cached in Experiment/Outputs/cache/words/<sha1 of pdf>.npz. Coordinates are page
+points with origin at the bottom left, as in reading rects and answer location tags.
+
+    index = WordIndex.for_pdf(os.path.join(ed.k_experimentDir, 'PDFs', 'Bener2011_asthma.pdf'))
+    word, line = index.map_fixations(pages, xs, ys)
+    index.words[word[word >= 0]]
+
+Precompute all experiment pdfs with ./word_index.py
+"""
+
+import os
+import sys
+import glob
+import hashlib
+import numpy as np
+
+import experiment_data as ed
+import spatial_join as sj
+
+k_tolerance = 3.  # fixations up to this many points away from a word / line still map to it
+
+
+def _union(boxes):
+    return min(b[0] for b in boxes), min(b[1] for b in boxes), max(b[2] for b in boxes), max(b[3] for b in boxes)
+
+
+def extract(pdf_path):
+    """ Words (page, line, x0, y0, x1, y1, text) and lines (page, x0, y0, x1, y1) of a pdf.
+    Lines are numbered per page from top to bottom. """
+    try:
+        from pdfminer.high_level import extract_pages
+        from pdfminer.layout import LAParams, LTContainer, LTTextLine, LTChar
+    except ImportError:
+        sys.exit('pdfminer.six is required to extract words (pip install pdfminer.six)')
+
+    def text_lines(obj):
+        # text can also be inside figures (e.g. pages stored as form xobjects)
+        if isinstance(obj, LTTextLine):
+            yield obj
+        elif isinstance(obj, LTContainer):
+            for child in obj:
+                for line in text_lines(child):
+                    yield line
+
+    words, lines = [], []
+    for page_index, page in enumerate(extract_pages(pdf_path, laparams=LAParams(all_texts=True))):
+        page_lines = []
+        for line in text_lines(page):
+            line_words = []
+            current = []
+            for char in line:
+                if isinstance(char, LTChar) and not char.get_text().isspace():
+                    current.append(char)
+                elif current:
+                    line_words.append(current)
+                    current = []
+            if current:
+                line_words.append(current)
+            if line_words:
+                page_lines.append((line.bbox, [(_union([c.bbox for c in w]), ''.join(c.get_text() for c in w)) for w in line_words]))
+        # top to bottom, then left to right
+        page_lines.sort(key=lambda l: (-l[0][3], l[0][0]))
+        for bbox, line_words in page_lines:
+            lines.append((page_index,) + tuple(bbox))
+            words.extend((page_index, len(lines) - 1) + tuple(wb) + (text,) for wb, text in line_words)
+    return words, lines
+
+
+class WordIndex(object):
+
+    def __init__(self, arrays):
+        self.word_page = arrays['word_page']
+        self.word_line = arrays['word_line']  # index into line arrays
+        self.word_box = arrays['word_box']  # x0, y0, x1, y1
+        self.words = arrays['words']
+        self.line_page = arrays['line_page']
+        self.line_box = arrays['line_box']
+        self._word_index = self._rect_index(self.word_page, self.word_box)
+        self._line_index = self._rect_index(self.line_page, self.line_box)
+
+    @staticmethod
+    def _rect_index(page, box):
+        return sj.RectIndex(page, box[:, 0], box[:, 1], box[:, 2] - box[:, 0], box[:, 3] - box[:, 1])
+
+    @classmethod
+    def for_pdf(cls, pdf_path, cache_dir=None):
+        """ Index of a pdf, extracted only if not in the cache. """
+        cache_dir = cache_dir or os.path.join(ed.default_cache_dir(), 'words')
+        with open(pdf_path, 'rb') as f:
+            digest = hashlib.sha1(f.read()).hexdigest()
+        cache_path = os.path.join(cache_dir, digest + '.npz')
+        if os.path.exists(cache_path):
+            with np.load(cache_path) as data:
+                return cls({k: data[k] for k in data.files})
+
+        words, lines = extract(pdf_path)
+        arrays = {'word_page': np.array([w[0] for w in words], dtype=np.int32),
+                  'word_line': np.array([w[1] for w in words], dtype=np.int32),
+                  'word_box': np.array([w[2:6] for w in words], dtype=np.float32).reshape(-1, 4),
+                  'words': np.array([w[6] for w in words], dtype=str),
+                  'line_page': np.array([l[0] for l in lines], dtype=np.int32),
+                  'line_box': np.array([l[1:5] for l in lines], dtype=np.float32).reshape(-1, 4)}
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp_path = cache_path + '.tmp.npz'
+        np.savez_compressed(tmp_path, **arrays)
+        os.replace(tmp_path, cache_path)
+        return cls(arrays)
+
+    @staticmethod
+    def _closest(index, n, page, x, y, tolerance):
+        """ For each point, row of the indexed rect overlapping most with a square of side 2 * tolerance
+        around it (so the closest one), -1 if none. """
+        side = 2. * max(tolerance, 1e-6)
+        q, i, area = index.join(page, np.asarray(x) - side / 2, np.asarray(y) - side / 2, np.full(n, side), np.full(n, side))
+        result = np.full(n, -1, dtype=np.int64)
+        order = np.lexsort((area, q))  # last pair of each query has the largest area
+        q, i = q[order], i[order]
+        last = np.append(q[1:] != q[:-1], True) if len(q) else np.zeros(0, dtype=bool)
+        result[q[last]] = i[last]
+        return result
+
+    def map_fixations(self, page, x, y, tolerance=k_tolerance):
+        """ Word and line index (-1 if none) of each fixation, given arrays of pageIndex, x and y. """
+        page = np.asarray(page)
+        n = len(page)
+        word = self._closest(self._word_index, n, page, x, y, tolerance)
+        line = self._closest(self._line_index, n, page, x, y, tolerance)
+        # a fixation on a word is on that word's line
+        line[word >= 0] = self.word_line[word[word >= 0]]
+        return word, line
+
+
+# ------------------------------------------------------------------------------
+# Precompute indexes of all experiment pdfs if started from the command line
+# ------------------------------------------------------------------------------
+if __name__ == '__main__':
+    for pdf_path in sorted(glob.glob(os.path.join(ed.k_experimentDir, 'PDFs', '*.pdf'))):
+        index = WordIndex.for_pdf(pdf_path)
+        print('{}: {} words, {} lines'.format(os.path.basename(pdf_path), len(index.words), len(index.line_page)))
@@ -0,0 +1,251 @@
+'''
+Offline re-processing of recorded pupil world videos.
+
+Re-runs marker detection and fixation-to-surface mapping (as done live by
+Surface_Tracker_Fixations.update) over a recording folder, using a
+surface_definitions file (e.g. one in Extras/Pupil labs/Surfaces).
+Frame ranges are processed in parallel by a process pool and results are
+cached per (video, surface definition, pupil data, camera calibration) set.
+
+Must be run with pupil's shared_modules in the python path, e.g.:
+
+    PYTHONPATH=~/pupil/pupil_src/shared_modules python3 offline_surface_fixations.py \
+        ~/recordings/2017_02_16/000 Surfaces/1/surface_definitions
+'''
+
+import os
+import argparse
+import csv
+import hashlib
+import multiprocessing as mp
+import cv2
+import numpy as np
+from file_methods import load_object, save_object
+#logging
+import logging
+logger = logging.getLogger(__name__)
+
+from square_marker_detect import detect_markers, detect_markers_robust
+from reference_surface import Reference_Surface
+
+# same defaults as Surface_Tracker_Fixations
+k_gridSize = 5
+k_aperture = 11
+k_minMarkerPerimeter = 100
+k_minIdConfidence = 0.0
+
+k_chunkSize = 300  # frames per work unit (10s of 30fps world video)
+k_seekBack = 30  # frames before the wanted one to seek to when a seek overshoots (doubled on each retry)
+k_cacheDir = 'offline_surface_fixations'  # created inside the recording folder
+
+
+def file_hash(path, block_size=1 << 20):
+    """ Sha1 of a whole file, read in blocks. """
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def files_hash(paths):
+    """ Sha1 of the hashes of some files (missing files count as empty). """
+    h = hashlib.sha1()
+    for path in paths:
+        h.update((file_hash(path) if os.path.exists(path) else '-').encode())
+    return h.hexdigest()
+
+
+def load_surfaces(definitions_path):
+    """ Load surfaces the same way the plugin does (realtime surfaces only). """
+    definitions = load_object(definitions_path)
+    return [Reference_Surface(saved_definition=d) for d in definitions.get('realtime_square_marker_surfaces', []) if isinstance(d, dict)]
+
+
+def load_camera_calibration(rec_dir):
+    try:
+        return load_object(os.path.join(rec_dir, 'camera_calibration'))
+    except Exception:
+        return None
+
+
+def correlate_to_frames(data, frame_timestamps):
+    """ Returns a list (one entry per frame) of data items closest in time to that frame. """
+    per_frame = [[] for _ in frame_timestamps]
+    if not data or not len(frame_timestamps):
+        return per_frame
+    ts = np.array([d['timestamp'] for d in data])
+    # midpoints between frames, so that each datum goes to the closest frame
+    bounds = (frame_timestamps[:-1] + frame_timestamps[1:]) / 2.
+    for datum, idx in zip(data, np.searchsorted(bounds, ts)):
+        per_frame[idx].append(datum)
+    return per_frame
+
+
+def frame_at(frame_times, msec):
+    """ Index of the frame whose time (ms since the first frame) is closest to msec. """
+    idx = int(np.searchsorted(frame_times, msec))
+    if idx == len(frame_times) or (idx > 0 and msec - frame_times[idx - 1] < frame_times[idx] - msec):
+        idx -= 1
+    return idx
+
+
+def read_frames(video_path, frame_timestamps, start, stop):
+    """ Yields (index, image) for frames [start, stop) of the world video.
+    Seeking in inter-coded (e.g. h264) videos may land on a nearby frame, and the capture's
+    own frame counter just repeats the seek target, so the frame actually read is found from
+    its presentation time, matched against the world timestamps. If it is before start, the
+    frames in between are skipped; if it is after (or nothing could be read), the seek is
+    retried k_seekBack frames earlier (doubling the distance each time). """
+    frame_times = (np.asarray(frame_timestamps) - frame_timestamps[0]) * 1000.
+    cap = cv2.VideoCapture(video_path)
+    try:
+        back = 0
+        while True:
+            target = max(0, start - back)
+            if target > 0:
+                cap.set(cv2.CAP_PROP_POS_FRAMES, target)
+            elif back:
+                # a new capture starts at frame 0 for sure
+                cap.release()
+                cap = cv2.VideoCapture(video_path)
+            ok, img = cap.read()
+            if ok:
+                idx = frame_at(frame_times, cap.get(cv2.CAP_PROP_POS_MSEC)) if target > 0 else 0
+                if idx <= start:
+                    break
+            elif target == 0:
+                logger.warning('Could not read frame 0 of {}'.format(video_path))
+                return
+            # landed after start (or past the end of the video)
+            back = max(k_seekBack, 2 * back)
+        if idx < start:
+            for idx in range(idx + 1, start + 1):
+                if not cap.grab():
+                    logger.warning('Could not read frame {} of {}'.format(idx, video_path))
+                    return
+            ok, img = cap.retrieve()
+        yield start, img
+        for idx in range(start + 1, stop):
+            ok, img = cap.read()
+            if not ok:
+                logger.warning('Could not read frame {} of {}'.format(idx, video_path))
+                return
+            yield idx, img
+    finally:
+        cap.release()
+
+
+def process_chunk(args):
+    """ Detects markers and maps gaze / fixations in frames [start, stop) of the world video.
+    Runs in a worker process, so surfaces are re-created from their definitions. """
+    video_path, timestamps_path, definitions_path, camera_calibration, start, stop, gaze, fixations, robust_detection, invert_image = args
+
+    surfaces = load_surfaces(definitions_path)
+    frame_timestamps = np.load(timestamps_path, mmap_mode='r')
+
+    markers = []
+    results = []
+    for idx, img in read_frames(video_path, frame_timestamps, start, stop):
+        gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+        if invert_image:
+            gray = 255 - gray
+
+        if robust_detection:
+            markers = detect_markers_robust(
+                gray, grid_size=k_gridSize, aperture=k_aperture,
+                prev_markers=markers,
+                true_detect_every_frame=3,
+                min_marker_perimeter=k_minMarkerPerimeter)
+        else:
+            markers = detect_markers(
+                gray, grid_size=k_gridSize, aperture=k_aperture,
+                min_marker_perimeter=k_minMarkerPerimeter)
+
+        frame_surfaces = []
+        for s in surfaces:
+            s.locate(markers, camera_calibration, k_minMarkerPerimeter, k_minIdConfidence, False)
+            if s.detected:
+                frame_surfaces.append({'name': s.name, 'uid': s.uid,
+                                       'm_to_screen': s.m_to_screen.tolist(),
+                                       'm_from_screen': s.m_from_screen.tolist(),
+                                       'gaze_on_srf': s.map_data_to_surface(gaze[idx - start], s.m_from_screen),
+                                       'fixations_on_srf': s.map_data_to_surface(fixations[idx - start], s.m_from_screen)})
+        results.append(frame_surfaces)
+
+    for s in surfaces:
+        s.cleanup()
+    return start, results
+
+
+def process_recording(rec_dir, definitions_path, n_processes=None, robust_detection=True, invert_image=False):
+    """ Returns a list (one per world frame) of detected surfaces, each with gaze and fixations mapped on it.
+    Results are cached in the recording folder, keyed by the hashes of all the files they depend on. """
+    video_path = next(os.path.join(rec_dir, 'world' + ext) for ext in ('.mp4', '.mkv', '.avi') if os.path.exists(os.path.join(rec_dir, 'world' + ext)))
+    timestamps_path = os.path.join(rec_dir, 'world_timestamps.npy')
+    frame_timestamps = np.load(timestamps_path)
+
+    inputs = [video_path, definitions_path, os.path.join(rec_dir, 'pupil_data'), os.path.join(rec_dir, 'camera_calibration')]
+    cache_key = '{}_{:d}{:d}'.format(files_hash(inputs)[:32], robust_detection, invert_image)
+    cache_path = os.path.join(rec_dir, k_cacheDir, cache_key)
+    if os.path.exists(cache_path):
+        logger.info('Using cached results in {}'.format(cache_path))
+        return load_object(cache_path)
+
+    pupil_data = load_object(os.path.join(rec_dir, 'pupil_data'))
+    gaze = correlate_to_frames(pupil_data.get('gaze_positions', []), frame_timestamps)
+    fixations = correlate_to_frames(pupil_data.get('fixations', []), frame_timestamps)
+    if not pupil_data.get('fixations'):
+        logger.warning('No fixations in recording. Run the offline fixation detector in pupil player first.')
+
+    camera_calibration = load_camera_calibration(rec_dir)
+    n_frames = len(frame_timestamps)
+    jobs = [(video_path, timestamps_path, definitions_path, camera_calibration, start, min(start + k_chunkSize, n_frames),
+             gaze[start:start + k_chunkSize], fixations[start:start + k_chunkSize], robust_detection, invert_image)
+            for start in range(0, n_frames, k_chunkSize)]
+
+    per_frame = [[] for _ in range(n_frames)]
+    with mp.Pool(n_processes) as pool:
+        for done, (start, results) in enumerate(pool.imap_unordered(process_chunk, jobs), 1):
+            per_frame[start:start + len(results)] = results
+            logger.info('Processed {}/{} chunks'.format(done, len(jobs)))
+
+    for frame_surfaces, ts in zip(per_frame, frame_timestamps):
+        for s in frame_surfaces:
+            s['timestamp'] = float(ts)
+
+    os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+    save_object(per_frame, cache_path)
+    return per_frame
+
+
+def export_fixations(per_frame, out_path):
+    """ Writes one row per (fixation, surface) to csv, with normalized surface coordinates. """
+    with open(out_path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(('surface_name', 'world_timestamp', 'fixation_id', 'fixation_timestamp', 'duration', 'x_norm', 'y_norm', 'on_srf'))
+        for frame_surfaces in per_frame:
+            for s in frame_surfaces:
+                for fix in s['fixations_on_srf']:
+                    base = fix['base_data']
+                    x, y = fix['norm_pos']
+                    writer.writerow((s['name'], s['timestamp'], base.get('id'), base['timestamp'], base.get('duration'), x, y, fix['on_srf']))
+
+
+# ------------------------------------------------------------------------------
+# Run if started from the command line
+# ------------------------------------------------------------------------------
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description='Map fixations of a pupil recording to surfaces, offline.')
+    parser.add_argument('rec_dir', help='pupil recording folder (containing world video, world_timestamps.npy and pupil_data)')
+    parser.add_argument('surface_definitions', help='surface_definitions file to use')
+    parser.add_argument('-j', '--processes', type=int, default=None, help='number of worker processes (default: number of cores)')
+    parser.add_argument('--no-robust', action='store_true', help='disable robust marker detection')
+    parser.add_argument('--invert', action='store_true', help='use inverted markers')
+    args = parser.parse_args()
+
+    per_frame = process_recording(args.rec_dir, args.surface_definitions, args.processes, not args.no_robust, args.invert)
+    out_path = os.path.join(args.rec_dir, k_cacheDir, 'fixations_on_surfaces.csv')
+    export_fixations(per_frame, out_path)
+    print('Written ' + out_path)
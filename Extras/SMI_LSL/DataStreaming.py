@@ -39,6 +39,10 @@ from iViewXAPI import  *            #iViewX library
 from iViewXAPIReturnCodes import * 
 import time
 import pylsl as lsl
+from OutletStats import OutletStats, StatsReporter
+from EventFilter import FixationFilter, START, END
+from ShmRing import ShmRingWriter
+from SamplingProfiler import SamplingProfiler, install_signal, k_profileSeconds
 
 def marcoTime():
     return int(round(time.time() * 1000) - 1446909066675)
@@ -76,6 +80,12 @@ k_nchans_event = 7  # event stream channels
 k_chunkSize = 32  # size of chunks (using example given by lsl)
 k_maxBuff = 30  # maximum buffer size in seconds
 
+k_coalesceEvents = True  # only send completed fixations on the event stream (see EventFilter.py)
+k_fixationStartStream = False  # send fixation starts on a separate SMI_FixationStart stream (requires k_coalesceEvents)
+k_sharedMemory = False  # also write samples to shared memory rings, read by the aggregate and reading rect feeders
+                        # of midas nodes on this machine (see ShmRing.py); the nodes' own buffers always use lsl
+k_profilerSignal = True  # profile for k_profileSeconds on SIGUSR1 / ctrl+break (see SamplingProfiler.py)
+
 # ---------------------------------------------
 # ---- lab streaming layer
 # ---------------------------------------------
@@ -148,6 +158,29 @@ for c in ["marcotime"]:
 rawOutlet = lsl.StreamOutlet(rawStream_info, k_chunkSize, k_maxBuff)
 eventOutlet = lsl.StreamOutlet(eventStream_info, k_chunkSize, k_maxBuff)
 
+# same buffer duration as outlets
+rawRing = eventRing = None
+if k_sharedMemory:
+    rawRing = ShmRingWriter('SMI_Raw', k_nchans_raw, int(k_maxBuff * samplingRate))
+    eventRing = ShmRingWriter('SMI_Event', k_nchans_event, int(k_maxBuff * samplingRate))
+
+fixationFilter = FixationFilter()
+startOutlet = None
+if k_coalesceEvents and k_fixationStartStream:
+    startStream_info = lsl.StreamInfo('SMI_FixationStart', 'Event', k_nchans_event, samplingRate, 'float32', 'smifixstart500ds15')
+    startStream_info.desc().append_child_value("manufacturer", "SMI")
+    startChannels = startStream_info.desc().append_child("channels")
+    # same channels as event stream
+    for c in ["eye", "startTime", "endTime", "duration", "positionX", "positionY", "marcotime"]:
+        startChannels.append_child("channel")\
+            .append_child_value("label", c)\
+            .append_child_value("type", "Event")
+    startOutlet = lsl.StreamOutlet(startStream_info, k_chunkSize, k_maxBuff)
+
+# sample timestamps are in microseconds, events are irregular
+rawStats = OutletStats('SMI_Raw', rawOutlet, samplingRate, k_maxBuff, time_scale=1000000)
+eventStats = OutletStats('SMI_Event', eventOutlet, None, k_maxBuff)
+
 # ---------------------------------------------
 # ---- configure and start calibration
 # ---------------------------------------------
@@ -212,11 +245,17 @@ def SampleCallback(sample):
     data[11] = sample.rightEye.eyePositionY
     data[12] = sample.rightEye.eyePositionZ
     rawOutlet.push_sample(data)
+    if rawRing is not None:
+        rawRing.write(lsl.local_clock(), data)
+    rawStats.calls += 1
+    rawStats.pushed += 1
+    rawStats.last_time = sample.timestamp
     
     return 0
 
 
 def EventCallback(event):
+    eventStats.calls += 1
     data = [None] * k_nchans_event
     data[0] = eyeDict[event.eye]
     data[1] = event.startTime
@@ -225,7 +264,18 @@ def EventCallback(event):
     data[4] = event.positionX
     data[5] = event.positionY
     data[6] = marcoTime()
+
+    if k_coalesceEvents:
+        kind = fixationFilter.classify(data)
+        if kind == START and startOutlet is not None:
+            startOutlet.push_sample(data)
+        if kind != END:
+            return 0
+
     eventOutlet.push_sample(data)
+    if eventRing is not None:
+        eventRing.write(lsl.local_clock(), data)
+    eventStats.pushed += 1
     
     return 0
 
@@ -246,14 +296,26 @@ sampleCB = True
 res = iViewXAPI.iV_SetEventCallback(event_func)
 eventCB = True
 
+statsReporter = StatsReporter([rawStats, eventStats])
+statsReporter.start()
+
+# callbacks run in the SDK's thread, which shows as foreign-<id> in profiles
+profiler = SamplingProfiler('DataStreaming')
+if k_profilerSignal:
+    install_signal(profiler)
+
 command = ''
 while not command == 'q':
     print('')
     print('STREAMING STARTED')
     print('')
-    command = raw_input('q+enter to stop streaming eye data. ')
+    command = raw_input('q+enter to stop streaming eye data, p+enter to profile for ' + str(k_profileSeconds) + ' seconds. ')
+    if command == 'p':
+        path = profiler.start()
+        print('Profiler already running' if path is None else 'Profiling, stacks will be written to ' + path)
 
 print('Terminating... ')
+statsReporter.stop()
 sampleCB = False
 eventCB = False
 
@@ -263,3 +325,8 @@ eventCB = False
 # ---------------------------------------------
 
 res = iViewXAPI.iV_Disconnect()
+
+# remove shared memory rings, so that nodes started later do not read stale ones
+for ring in (rawRing, eventRing):
+    if ring is not None:
+        ring.close()
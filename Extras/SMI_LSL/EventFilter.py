@@ -0,0 +1,36 @@
+# Works with both python 2 (DataStreaming.py) and 3 (FakeStream.py).
+# Coalesces fixation events: the SMI event stream may contain records of fixations
+# which are still open (endTime and duration 0) in addition to completed ones.
+# Open records are held per eye and only completed fixations are passed on (once),
+# so that consumers do not have to filter them. Open records can optionally be sent
+# to a separate "fixation started" outlet, for consumers that need them early.
+#
+# Events are lists in the event stream's channel order:
+# eye, startTime, endTime, duration, positionX, positionY, marcotime
+
+k_EYE, k_START, k_END, k_DURATION = 0, 1, 2, 3
+
+START = 'start'
+END = 'end'
+
+
+class FixationFilter(object):
+
+    def __init__(self):
+        self.open = {}  # eye -> open fixation record
+        self.last_completed = {}  # eye -> startTime of the last completed fixation
+
+    def classify(self, event):
+        """ Returns END if the event is a completed fixation that should be published,
+        START if it opens a fixation (not published on the main stream), None if it is a duplicate. """
+        eye = event[k_EYE]
+        if event[k_END] == 0 and event[k_DURATION] == 0:
+            if eye in self.open and self.open[eye][k_START] == event[k_START]:
+                return None
+            self.open[eye] = event
+            return START
+        if self.last_completed.get(eye) == event[k_START]:
+            return None
+        self.open.pop(eye, None)
+        self.last_completed[eye] = event[k_START]
+        return END
@@ -0,0 +1,153 @@
+# Works with both python 2 (DataStreaming.py) and 3 (FakeStream.py).
+# Periodically reports the health of lsl outlets: callback and push rates compared to
+# the nominal sampling rate (if the outlet has one), consumer presence, samples
+# estimated dropped (gaps in the source's timestamps), samples discarded because
+# no consumer was connected and how late samples reach the callbacks (lag, see update()).
+# Latest stats are printed every k_statsInterval seconds and served as json on
+# http://127.0.0.1:k_statsPort/ (if the port is free).
+#
+# The only per-sample cost is in the callbacks, which must do:
+#     stats.calls += 1  (on every call, also when nothing is pushed)
+#     stats.pushed += 1  (when a sample is pushed)
+#     stats.last_time = <source timestamp>  (only if time_scale is given)
+
+import json
+import socket
+import threading
+import time
+
+try:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+except ImportError:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+
+k_statsInterval = 10  # seconds between stats lines
+k_statsPort = 8090  # local http port serving latest stats (0 to disable)
+
+
+class OutletStats(object):
+    """ Counters for one outlet. nominal_rate: samples per second, None if the outlet's samples are
+    not regular (events). time_scale: source timestamp units per second (e.g. 1e6 for microseconds),
+    None if samples are not regular. """
+
+    def __init__(self, name, outlet, nominal_rate, max_buffered, time_scale=None):
+        self.name = name
+        self.outlet = outlet
+        self.nominal_rate = nominal_rate
+        self.max_buffered = max_buffered  # seconds buffered by the outlet (k_maxBuff)
+        self.time_scale = time_scale
+
+        # updated by the sample callbacks
+        self.calls = 0
+        self.pushed = 0
+        self.last_time = None
+
+        # updated by the reporter
+        self.dropped = 0
+        self.discarded = 0
+        self.latest = {}
+        self._prev_calls = 0
+        self._prev_pushed = 0
+        self._prev_time = None
+        self._min_offset = None
+
+    def update(self, elapsed):
+        """ Computes stats since the previous update, elapsed seconds ago.
+        Lag is how much later than usual the latest sample reached the callback: the difference
+        between wall clock and source timestamp, minus the smallest difference seen so far
+        (sampled once per update, so it shows sustained delays, not single late samples). """
+        calls, pushed, last_time, now = self.calls, self.pushed, self.last_time, time.time()
+        new = pushed - self._prev_pushed
+        new_calls = calls - self._prev_calls
+        consumers = self.outlet.have_consumers()
+        if not consumers:
+            self.discarded += new
+        if self.time_scale is not None and last_time is not None and self._prev_time is not None:
+            expected = (last_time - self._prev_time) / float(self.time_scale) * self.nominal_rate
+            self.dropped += max(0, int(round(expected - new)))
+        lag = None
+        if self.time_scale is not None and last_time is not None:
+            offset = now - last_time / float(self.time_scale)
+            if self._min_offset is None or offset < self._min_offset:
+                self._min_offset = offset
+            lag = offset - self._min_offset
+        self._prev_calls, self._prev_pushed, self._prev_time = calls, pushed, last_time
+
+        rate = new / elapsed if elapsed > 0 else 0.
+        call_rate = new_calls / elapsed if elapsed > 0 else 0.
+        self.latest = {'outlet': self.name,
+                       'calls': calls,
+                       'callRate': round(call_rate, 1),
+                       'pushed': pushed,
+                       'rate': round(rate, 1),
+                       'nominalRate': self.nominal_rate,
+                       'callRatio': round(call_rate / self.nominal_rate, 3) if self.nominal_rate else None,
+                       'rateRatio': round(rate / self.nominal_rate, 3) if self.nominal_rate else None,
+                       'haveConsumers': bool(consumers),
+                       'bufferCapacity': int(self.max_buffered * self.nominal_rate) if self.nominal_rate else None,
+                       'dropped': self.dropped,
+                       'discarded': self.discarded,
+                       'lagMs': round(lag * 1000., 1) if lag is not None else None}
+        return self.latest
+
+    def line(self):
+        l = self.latest
+        rate = '{rate}/{nominalRate} Hz' if self.nominal_rate else '{rate} Hz'
+        lag = ', lag: {lagMs} ms' if l['lagMs'] is not None else ''
+        return ('{outlet}: ' + rate + ' ({callRate} calls/s), consumers: {haveConsumers}, '
+                'dropped: {dropped}, discarded: {discarded}' + lag).format(**l)
+
+
+class StatsReporter(threading.Thread):
+    """ Updates and prints stats of all outlets every interval seconds and serves them on a local port.
+    If the port cannot be bound (e.g. another streaming script uses it), stats are only printed. """
+
+    def __init__(self, outlet_stats, interval=k_statsInterval, port=k_statsPort, print_lines=True):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.outlet_stats = outlet_stats
+        self.interval = interval
+        self.print_lines = print_lines
+        self.stopped = threading.Event()
+        self.server = None
+        if port:
+            try:
+                self.server = HTTPServer(('127.0.0.1', port), self._handler())
+            except socket.error as e:
+                print('Stats not served: could not bind port {} ({}), set k_statsPort to another port'.format(port, e))
+                return
+            server_thread = threading.Thread(target=self.server.serve_forever)
+            server_thread.daemon = True
+            server_thread.start()
+
+    def _handler(self):
+        reporter = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = json.dumps([s.latest for s in reporter.outlet_stats]).encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+    def run(self):
+        prev = time.time()
+        while not self.stopped.wait(self.interval):
+            now = time.time()
+            for s in self.outlet_stats:
+                s.update(now - prev)
+            prev = now
+            if self.print_lines:
+                print(' | '.join(s.line() for s in self.outlet_stats))
+
+    def stop(self):
+        self.stopped.set()
+        if self.server is not None:
+            self.server.shutdown()
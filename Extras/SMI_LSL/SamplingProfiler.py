@@ -0,0 +1,119 @@
+# Works with both python 2 (DataStreaming.py) and 3 (FakeStream.py, midas node and dispatcher).
+# On demand sampling profiler. When started for some seconds, a background thread takes
+# the stacks of all threads of the process (sys._current_frames) k_sampleRate times per
+# second and counts identical stacks. When done, counts are written as a collapsed stack
+# file (one "thread;outer;...;inner count" line per stack), which flamegraph.pl or
+# speedscope can display.
+# Nothing runs and nothing is checked in the profiled code while the profiler is off.
+#
+# Threads started from C (e.g. the iViewX SDK callback thread) are not known to the
+# threading module: they are named "foreign-<ident>" and their stacks start at the
+# python callback (SampleCallback / EventCallback).
+
+import os
+import sys
+import threading
+import time
+
+k_sampleRate = 200  # stack samples per second while profiling
+k_profileSeconds = 30  # default profiling duration
+k_profileDir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'profiles')
+
+
+def code_label(code):
+    # ';' separates frames and ' ' the count in collapsed stacks
+    return '{} ({}:{})'.format(code.co_name, os.path.basename(code.co_filename), code.co_firstlineno).replace(';', ':')
+
+
+class SamplingProfiler(object):
+    """ One per process. start() returns the path the collapsed stacks will be written to,
+    or None if the profiler is already running. """
+
+    def __init__(self, name, sample_rate=k_sampleRate, out_dir=k_profileDir):
+        self.name = name
+        self.sample_rate = sample_rate
+        self.out_dir = out_dir
+        self.lock = threading.Lock()
+        self.thread = None
+
+    @property
+    def running(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    def start(self, seconds=k_profileSeconds, path=None):
+        with self.lock:
+            if self.running:
+                return None
+            if path is None:
+                stamp = time.strftime('%Y%m%d_%H%M%S')
+                path = os.path.join(self.out_dir, '{}_{}_{}.collapsed'.format(self.name, os.getpid(), stamp))
+            self.thread = threading.Thread(target=self._run, args=(float(seconds), path))
+            self.thread.daemon = True
+            self.thread.start()
+            return path
+
+    def _run(self, seconds, path):
+        own = threading.current_thread().ident
+        interval = 1. / self.sample_rate
+        counts = {}
+        names = {}
+        labels = {}
+        samples = 0
+        end = time.time() + seconds
+        next_sample = time.time()
+        while next_sample < end:
+            frames = sys._current_frames()
+            for ident, frame in frames.items():
+                if ident == own:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    label = labels.get(code)
+                    if label is None:
+                        label = labels[code] = code_label(code)
+                    stack.append(label)
+                    frame = frame.f_back
+                if ident not in names:
+                    names[ident] = self._thread_name(ident)
+                stack.append(names[ident])
+                key = ';'.join(reversed(stack))
+                counts[key] = counts.get(key, 0) + 1
+            frames = None  # do not keep other threads' frames alive while sleeping
+            samples += 1
+            next_sample += interval
+            time.sleep(max(0., next_sample - time.time()))
+        self._write(path, counts)
+        print('Profiler: {} samples written to {}'.format(samples, path))
+
+    @staticmethod
+    def _thread_name(ident):
+        for t in threading.enumerate():
+            if t.ident == ident and not isinstance(t, threading._DummyThread):
+                return t.name.replace(' ', '_').replace(';', ':')
+        return 'foreign-{}'.format(ident)
+
+    @staticmethod
+    def _write(path, counts):
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        with open(path, 'w') as f:
+            for stack, count in sorted(counts.items()):
+                f.write('{} {}\n'.format(stack, count))
+
+
+def install_signal(profiler, seconds=k_profileSeconds):
+    """ Starts profiling for seconds when the process receives SIGUSR1 (ctrl+break on windows).
+    Must be called from the main thread. Returns the name of the signal used, None if unavailable. """
+    import signal
+    signum = getattr(signal, 'SIGUSR1', None) or getattr(signal, 'SIGBREAK', None)
+    if signum is None:
+        return None
+
+    def handler(signum, frame):
+        path = profiler.start(seconds)
+        print('Profiler already running' if path is None else 'Profiling for {} seconds'.format(seconds))
+
+    signal.signal(signum, handler)
+    return 'SIGUSR1' if signum == getattr(signal, 'SIGUSR1', None) else 'SIGBREAK'
@@ -0,0 +1,172 @@
+# Works with both python 2 (DataStreaming.py, writer) and 3 (midas node, reader).
+# Shared memory ring buffer for passing samples to processes on the same machine
+# without going through lsl's network stack.
+#
+# The ring is a memory mapped file (a named mapping on windows) laid out as:
+#   header: magic (8 bytes), n_channels (uint32), capacity (uint32), next sequence number (uint64),
+#           heartbeat (float64, unix time), writer pid (uint64)
+#   capacity records of: sequence number (uint64), lsl time (float64), n_channels values (float64)
+# The writer fills a record, then sets its sequence number, then advances the header's
+# sequence number. Readers keep their own cursor (next sequence number to read) and
+# check record sequence numbers to detect records that were overwritten while reading,
+# so that no locking is needed. There must be only one writer per ring.
+# A thread of the writer's process updates the heartbeat every k_heartbeatInterval seconds,
+# also while no samples are written (e.g. during calibration, or when no fixation ends), so
+# that readers can tell a quiet ring from one whose writer is gone (stale()).
+# The writer removes the ring when closed (also at exit). A new writer does not reuse the file
+# of a previous one (on windows it reuses a mapping still held by readers, which then see the
+# sequence number restart), so readers of a stale ring can open it again to find a new writer.
+
+import atexit
+import mmap
+import os
+import struct
+import sys
+import tempfile
+import threading
+import time
+
+k_magic = b'PEYERNG2'
+k_headerFmt = '<8sIIQdQ'
+k_headerSize = struct.calcsize(k_headerFmt)
+k_seqOffset = 16  # offset of next sequence number in header
+k_heartbeatOffset = 24  # offset of heartbeat in header
+k_heartbeatInterval = 1.  # seconds between heartbeats of the writer
+k_staleAfter = 5.  # seconds without heartbeat after which the writer is considered gone
+k_writingBytes = struct.pack('<Q', 0xFFFFFFFFFFFFFFFF)  # sequence number of a record being written
+
+
+def ring_path(name):
+    """ Name of the mapping on windows, file path elsewhere. """
+    if sys.platform == 'win32':
+        return 'PeyeDF_' + name
+    base = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+    return os.path.join(base, 'PeyeDF_' + name)
+
+
+def _map(name, size, create):
+    path = ring_path(name)
+    if sys.platform == 'win32':
+        return mmap.mmap(-1, size, tagname=path)
+    fd = os.open(path, os.O_RDWR | (os.O_CREAT if create else 0))
+    try:
+        if create:
+            os.ftruncate(fd, size)
+        return mmap.mmap(fd, size)
+    finally:
+        os.close(fd)
+
+
+class ShmRingWriter(object):
+    """ Creates (or replaces) a ring and appends samples to it. """
+
+    def __init__(self, name, n_channels, capacity):
+        self.n_channels = n_channels
+        self.capacity = capacity
+        self.values_fmt = '<d{}d'.format(n_channels)
+        self.record_size = 8 + struct.calcsize(self.values_fmt)
+        self.path = ring_path(name)
+        if sys.platform != 'win32':
+            # a ring left by a writer that did not exit cleanly may still be mapped by readers,
+            # which must not see it resized or restarted
+            try:
+                os.unlink(self.path)
+            except OSError:
+                pass
+        self.buf = _map(name, k_headerSize + capacity * self.record_size, True)
+        struct.pack_into(k_headerFmt, self.buf, 0, k_magic, n_channels, capacity, 0, time.time(), os.getpid())
+        self.seq = 0
+        self.closed = False
+        self.lock = threading.Lock()  # heartbeat thread vs close
+        self.stopped = threading.Event()
+        thread = threading.Thread(target=self._beat, name='ring_heartbeat')
+        thread.daemon = True
+        thread.start()
+        atexit.register(self.close)
+
+    def _beat(self):
+        while not self.stopped.wait(k_heartbeatInterval):
+            with self.lock:
+                if self.closed:
+                    return
+                self.buf[k_heartbeatOffset:k_heartbeatOffset + 8] = struct.pack('<d', time.time())
+
+    def write(self, t, values):
+        """ Appends one sample (values: n_channels numbers) with the given lsl time. """
+        # slice assignments are single memory copies (struct.pack_into may write byte by byte,
+        # so readers could see half written sequence numbers)
+        offset = k_headerSize + (self.seq % self.capacity) * self.record_size
+        self.buf[offset:offset + 8] = k_writingBytes
+        self.buf[offset + 8:offset + self.record_size] = struct.pack(self.values_fmt, t, *values)
+        self.buf[offset:offset + 8] = struct.pack('<Q', self.seq)
+        self.seq += 1
+        self.buf[k_seqOffset:k_seqOffset + 8] = struct.pack('<Q', self.seq)
+
+    def close(self):
+        """ Unmaps and removes the ring (readers that still map it keep their copy, which stops advancing). """
+        with self.lock:
+            if self.closed:
+                return
+            self.closed = True
+            self.stopped.set()
+            self.buf.close()
+        if sys.platform != 'win32':
+            # windows removes named mappings when their last handle is closed
+            try:
+                os.unlink(self.path)
+            except OSError:
+                pass
+
+
+class ShmRingReader(object):
+    """ Maps an existing ring and reads the records written since the last read (requires numpy). """
+
+    def __init__(self, name, from_start=False):
+        import numpy as np
+        self.np = np
+        header = _map(name, k_headerSize, False)
+        magic, n_channels, capacity, seq, _, pid = struct.unpack_from(k_headerFmt, header, 0)
+        header.close()
+        if magic != k_magic:
+            raise IOError('No shared memory ring named ' + name)
+        self.n_channels = n_channels
+        self.capacity = capacity
+        self.writer_pid = pid
+        dtype = np.dtype([('seq', '<u8'), ('time', '<f8'), ('values', '<f8', (n_channels,))])
+        self.buf = _map(name, k_headerSize + capacity * dtype.itemsize, False)
+        # zero-copy views of the mapping
+        self.header_seq = np.frombuffer(self.buf, dtype='<u8', count=1, offset=k_seqOffset)
+        self.heartbeat = np.frombuffer(self.buf, dtype='<f8', count=1, offset=k_heartbeatOffset)
+        self.records = np.frombuffer(self.buf, dtype=dtype, count=capacity, offset=k_headerSize)
+        self.cursor = max(0, seq - capacity) if from_start else seq
+        self.lost = 0  # records overwritten before they could be read
+
+    def read(self):
+        """ Returns (times, values) of records written since the last read: arrays of
+        shape (n,) and (n, n_channels). """
+        np = self.np
+        end = int(self.header_seq[0])
+        if end < self.cursor:
+            # writer was restarted
+            self.cursor = max(0, end - self.capacity)
+        start = max(self.cursor, end - self.capacity)
+        self.lost += start - self.cursor
+        seqs = np.arange(start, end, dtype=np.uint64)
+        slots = seqs % self.capacity
+        chunk = self.records[slots]  # copy, then check it was not overwritten meanwhile
+        # sequence numbers are checked again after the copy: a record overwritten after its
+        # sequence number was copied but before its values were has a new (or the writing) one
+        ok = (chunk['seq'] == seqs) & (self.records['seq'][slots] == seqs)
+        if not ok.all():
+            self.lost += int(len(ok) - ok.sum())
+            chunk = chunk[ok]
+        self.cursor = end
+        return chunk['time'], chunk['values']
+
+    def stale(self):
+        """ True if the writer stopped updating the heartbeat (it exited, crashed or hangs). """
+        return time.time() - float(self.heartbeat[0]) > k_staleAfter
+
+    def close(self):
+        del self.header_seq, self.heartbeat, self.records
+        self.buf.close()
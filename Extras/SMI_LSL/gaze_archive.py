@@ -0,0 +1,331 @@
+#!/usr/bin/env python3
+
+"""
+Compact archival format for recorded SMI raw (13 channel) and event (7 channel) streams,
+with the channel layouts used in DataStreaming.py.
+
+Samples are quantised to fixed precision integers, delta encoded and zlib compressed
+in blocks of k_blockRows samples. Each block stores the first value of each channel
+and the deltas after it, in the smallest integer type that holds them. A block index (first / last time of each block)
+is stored at the end of the file, so that readers only decode the blocks that
+overlap a requested time range.
+
+Times are 'timestamp' (microseconds) for raw data and 'marcotime' (milliseconds) for events.
+Lsl streams are float32, which cannot hold these values exactly (recent marcotimes are
+rounded to tens of seconds), so archives recorded from lsl or converted from xdf also
+store the lsl timestamp of each sample in an 'lslTime' channel (seconds, to the microsecond)
+and use it as their time channel.
+
+    ./gaze_archive.py convert raw recording.csv recording.gza    # csv with channel names in header
+    ./gaze_archive.py convert event recording.xdf events.gza     # requires pyxdf
+    ./gaze_archive.py record raw session.gza                     # from lsl (requires pylsl)
+    ./gaze_archive.py info session.gza
+
+    with GazeArchive('session.gza') as arc:
+        for block in arc.iter_range(t0, t1):
+            block['leftGazeX'] ...
+"""
+
+import os
+import sys
+import json
+import struct
+import zlib
+import csv
+import argparse
+import numpy as np
+
+k_magic = b'GZARCH02'
+k_oldMagics = [b'GZARCH01']  # still readable (blocks store deltas from zero, without first values)
+k_blockRows = 4096  # samples per block (about 8s of raw data at 500Hz)
+
+# (channel name, scale); values are stored as round(value * scale)
+# keep in same order as in DataStreaming.py
+k_layouts = {
+    'raw': {'stream': 'SMI_Raw', 'time': 'timestamp', 'channels': [
+        ('timestamp', 1),  # microseconds
+        ('leftGazeX', 10), ('leftGazeY', 10),  # pixels, 0.1 px
+        ('leftDiam', 1000),  # millimetres, 0.001 mm
+        ('leftEyePositionX', 100), ('leftEyePositionY', 100), ('leftEyePositionZ', 100),  # millimetres, 0.01 mm
+        ('rightGazeX', 10), ('rightGazeY', 10),
+        ('rightDiam', 1000),
+        ('rightEyePositionX', 100), ('rightEyePositionY', 100), ('rightEyePositionZ', 100)]},
+    'event': {'stream': 'SMI_Event', 'time': 'marcotime', 'channels': [
+        ('eye', 1),  # -1 left, 1 right, 0 unknown
+        ('startTime', 1), ('endTime', 1), ('duration', 1),  # microseconds
+        ('positionX', 10), ('positionY', 10),  # pixels, 0.1 px
+        ('marcotime', 1)]},  # milliseconds
+}
+
+k_lslTime = ('lslTime', 1000000)  # seconds, 1 us
+
+k_dtypes = [np.int8, np.int16, np.int32, np.int64]
+
+
+# ---------------------------------------------
+# ---- block encoding
+# ---------------------------------------------
+
+def _encode_block(columns):
+    """ columns: list of non empty int64 arrays (quantised). Returns compressed bytes:
+    number of rows, a dtype code per column, the first value of each column (int64),
+    then the deltas of each column after its first value. """
+    codes, firsts, payload = [], [], []
+    for col in columns:
+        deltas = np.diff(col)
+        lo, hi = (deltas.min(), deltas.max()) if len(deltas) else (0, 0)
+        code = next(i for i, dt in enumerate(k_dtypes) if np.iinfo(dt).min <= lo and hi <= np.iinfo(dt).max)
+        codes.append(code)
+        firsts.append(int(col[0]))
+        payload.append(deltas.astype(k_dtypes[code]).tobytes())
+    n = len(columns)
+    header = struct.pack('<I{}B{}q'.format(n, n), len(columns[0]), *(codes + firsts))
+    return zlib.compress(header + b''.join(payload), 6)
+
+
+def _decode_block(data, n_channels, first_values=True):
+    """ Inverse of _encode_block. Without first_values, decodes blocks of old (GZARCH01)
+    archives, whose deltas start from zero. """
+    raw = zlib.decompress(data)
+    n_rows, = struct.unpack_from('<I', raw, 0)
+    codes = struct.unpack_from('<{}B'.format(n_channels), raw, 4)
+    offset = 4 + n_channels
+    if first_values:
+        firsts = struct.unpack_from('<{}q'.format(n_channels), raw, offset)
+        offset += 8 * n_channels
+    n_deltas = n_rows - 1 if first_values else n_rows
+    columns = []
+    for c, code in enumerate(codes):
+        dt = np.dtype(k_dtypes[code])
+        deltas = np.frombuffer(raw, dtype=dt, count=n_deltas, offset=offset)
+        offset += n_deltas * dt.itemsize
+        if first_values:
+            col = np.empty(n_rows, dtype=np.int64)
+            col[0] = firsts[c]
+            np.cumsum(deltas, dtype=np.int64, out=col[1:])
+            col[1:] += firsts[c]
+        else:
+            col = np.cumsum(deltas, dtype=np.int64)
+        columns.append(col)
+    return columns
+
+
+# ---------------------------------------------
+# ---- writer / reader
+# ---------------------------------------------
+
+class GazeArchiveWriter(object):
+    """ Appends samples (rows in the layout's channel order) to a new archive.
+    With lsl_time, each append must also give the samples' lsl timestamps, which become the time channel. """
+
+    def __init__(self, path, layout, lsl_time=False):
+        self.layout = layout
+        self.lsl_time = lsl_time
+        self.channels = k_layouts[layout]['channels'] + ([k_lslTime] if lsl_time else [])
+        self.scales = np.array([s for _, s in self.channels], dtype=np.float64)
+        time_channel = k_lslTime[0] if lsl_time else k_layouts[layout]['time']
+        self.time_col = [c for c, _ in self.channels].index(time_channel)
+        self.f = open(path, 'wb')
+        header = json.dumps({'layout': layout, 'channels': self.channels, 'time': time_channel, 'blockRows': k_blockRows}).encode()
+        self.f.write(k_magic + struct.pack('<I', len(header)) + header)
+        self.index = []  # (first time, last time, offset, length, rows)
+        self._pending = []
+        self._n_pending = 0
+
+    def append(self, rows, lsl_times=None):
+        """ Adds samples; rows is a 2d array like (n samples x n channels), or a single sample. """
+        rows = np.atleast_2d(np.asarray(rows, dtype=np.float64))
+        if self.lsl_time:
+            if lsl_times is None or len(lsl_times) != len(rows):
+                raise ValueError('Archives with lsl time need one lsl timestamp per sample')
+            rows = np.column_stack([rows, np.asarray(lsl_times, dtype=np.float64)])
+        self._pending.append(rows)
+        self._n_pending += len(rows)
+        while self._n_pending >= k_blockRows:
+            pending = np.concatenate(self._pending)
+            self._write_block(pending[:k_blockRows])
+            self._pending = [pending[k_blockRows:]]
+            self._n_pending = len(self._pending[0])
+
+    def _write_block(self, rows):
+        quantised = np.round(np.nan_to_num(rows) * self.scales).astype(np.int64)
+        data = _encode_block([quantised[:, i] for i in range(len(self.channels))])
+        times = quantised[:, self.time_col]
+        self.index.append((int(times.min()), int(times.max()), self.f.tell(), len(data), len(rows)))
+        self.f.write(data)
+
+    def close(self):
+        if self._n_pending:
+            self._write_block(np.concatenate(self._pending))
+            self._pending, self._n_pending = [], 0
+        index_offset = self.f.tell()
+        np.array(self.index, dtype=np.int64).reshape(-1, 5).tofile(self.f)
+        self.f.write(struct.pack('<QQ', index_offset, len(self.index)))
+        self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class GazeArchive(object):
+    """ Reads an archive. Data is returned as dicts of channel name -> float64 array. """
+
+    def __init__(self, path):
+        self.f = open(path, 'rb')
+        magic = self.f.read(len(k_magic))
+        if magic != k_magic and magic not in k_oldMagics:
+            raise ValueError(path + ' is not a gaze archive')
+        self.first_values = magic == k_magic
+        header_len, = struct.unpack('<I', self.f.read(4))
+        header = json.loads(self.f.read(header_len).decode())
+        self.layout = header['layout']
+        self.channels = [c for c, _ in header['channels']]
+        self.scales = np.array([s for _, s in header['channels']], dtype=np.float64)
+        self.time_channel = header.get('time', k_layouts[self.layout]['time'])
+        self.time_scale = self.scales[self.channels.index(self.time_channel)]
+
+        self.f.seek(-16, os.SEEK_END)
+        index_offset, n_blocks = struct.unpack('<QQ', self.f.read(16))
+        self.f.seek(index_offset)
+        self.index = np.fromfile(self.f, dtype=np.int64, count=n_blocks * 5).reshape(-1, 5)
+
+    def __len__(self):
+        return int(self.index[:, 4].sum())
+
+    @property
+    def time_range(self):
+        """ First and last time in the archive (in the time channel's units). """
+        if not len(self.index):
+            return None
+        return float(self.index[:, 0].min() / self.time_scale), float(self.index[:, 1].max() / self.time_scale)
+
+    def _read_block(self, b):
+        _, _, offset, length, _ = self.index[b]
+        self.f.seek(offset)
+        columns = _decode_block(self.f.read(length), len(self.channels), self.first_values)
+        return {c: col / s for c, col, s in zip(self.channels, columns, self.scales)}
+
+    def iter_range(self, start=None, stop=None):
+        """ Yields one dict per block that overlaps [start, stop] (inclusive, in time channel units),
+        with only the samples within the range. """
+        # the index holds quantised times
+        first, last = self.index[:, 0] / self.time_scale, self.index[:, 1] / self.time_scale
+        touched = np.ones(len(self.index), dtype=bool)
+        if start is not None:
+            touched &= last >= start
+        if stop is not None:
+            touched &= first <= stop
+        for b in np.flatnonzero(touched):
+            block = self._read_block(b)
+            times = block[self.time_channel]
+            mask = np.ones(len(times), dtype=bool)
+            if start is not None:
+                mask &= times >= start
+            if stop is not None:
+                mask &= times <= stop
+            if mask.any():
+                yield {c: v[mask] for c, v in block.items()}
+
+    def read(self, start=None, stop=None):
+        """ All samples in [start, stop] as a single dict. """
+        blocks = list(self.iter_range(start, stop))
+        if not blocks:
+            return {c: np.empty(0) for c in self.channels}
+        return {c: np.concatenate([b[c] for b in blocks]) for c in self.channels}
+
+    def close(self):
+        self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+# ---------------------------------------------
+# ---- converters
+# ---------------------------------------------
+
+def convert_csv(layout, in_path, out_path):
+    """ Csv with a header containing (at least) all the layout's channel names. """
+    names = [c for c, _ in k_layouts[layout]['channels']]
+    with open(in_path, newline='') as f, GazeArchiveWriter(out_path, layout) as writer:
+        reader = csv.DictReader(f)
+        rows = []
+        for line in reader:
+            rows.append([float(line[c]) for c in names])
+            if len(rows) == k_blockRows:
+                writer.append(rows)
+                rows = []
+        if rows:
+            writer.append(rows)
+
+
+def convert_xdf(layout, in_path, out_path):
+    """ First stream named as in the layout (SMI_Raw or SMI_Event) in an xdf file (e.g. from LabRecorder). """
+    try:
+        import pyxdf
+    except ImportError:
+        sys.exit('pyxdf is required to convert xdf files (pip install pyxdf)')
+    streams, _ = pyxdf.load_xdf(in_path)
+    name = k_layouts[layout]['stream']
+    stream = next((s for s in streams if s['info']['name'][0] == name), None)
+    if stream is None:
+        sys.exit('No {} stream in {}'.format(name, in_path))
+    with GazeArchiveWriter(out_path, layout, lsl_time=True) as writer:
+        writer.append(stream['time_series'], stream['time_stamps'])
+
+
+def record(layout, out_path):
+    """ Records the layout's lsl stream until interrupted with ctrl-c. """
+    import pylsl as lsl
+    name = k_layouts[layout]['stream']
+    print('Waiting for ' + name)
+    inlet = lsl.StreamInlet(lsl.resolve_byprop('name', name)[0])
+    with GazeArchiveWriter(out_path, layout, lsl_time=True) as writer:
+        print('Recording, ctrl-c to stop')
+        try:
+            while True:
+                chunk, times = inlet.pull_chunk(timeout=1.0)
+                if chunk:
+                    offset = inlet.time_correction()
+                    writer.append(chunk, [t + offset for t in times])
+        except KeyboardInterrupt:
+            pass
+    print('Terminating... ')
+
+
+# ------------------------------------------------------------------------------
+# Run if started from the command line
+# ------------------------------------------------------------------------------
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compact archives of SMI raw / event recordings.')
+    sub = parser.add_subparsers(dest='command')
+    p = sub.add_parser('convert', help='convert a csv or xdf recording')
+    p.add_argument('layout', choices=sorted(k_layouts))
+    p.add_argument('input')
+    p.add_argument('output')
+    p = sub.add_parser('record', help='record from lsl')
+    p.add_argument('layout', choices=sorted(k_layouts))
+    p.add_argument('output')
+    p = sub.add_parser('info', help='show archive summary')
+    p.add_argument('input')
+    args = parser.parse_args()
+
+    if args.command == 'convert':
+        if args.input.lower().endswith('.xdf'):
+            convert_xdf(args.layout, args.input, args.output)
+        else:
+            convert_csv(args.layout, args.input, args.output)
+        print('{}: {} -> {} bytes'.format(args.output, os.path.getsize(args.input), os.path.getsize(args.output)))
+    elif args.command == 'record':
+        record(args.layout, args.output)
+    elif args.command == 'info':
+        with GazeArchive(args.input) as arc:
+            print('{} archive, {} samples in {} blocks, {} range: {}'.format(arc.layout, len(arc), len(arc.index), arc.time_channel, arc.time_range))
+    else:
+        parser.print_help()
@@ -5,6 +5,13 @@ import time
 import pylsl as lsl
 import random
 import threading
+import os
+import sys
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'SMI_LSL'))
+from OutletStats import OutletStats, StatsReporter
+from EventFilter import FixationFilter, START, END
+from ShmRing import ShmRingWriter
+from SamplingProfiler import SamplingProfiler, install_signal, k_profileSeconds
 
 global stop
 stop = False
@@ -29,6 +36,12 @@ k_nchans_event = 7  # event stream channels
 k_chunkSize = 32  # size of chunks (using example given by lsl)
 k_maxBuff = 30  # maximum buffer size in seconds
 
+k_coalesceEvents = True  # only send completed fixations on the event stream (see EventFilter.py)
+k_fixationStartStream = False  # send fixation starts on a separate SMI_FixationStart stream (requires k_coalesceEvents)
+k_sharedMemory = False  # also write samples to shared memory rings, read by the aggregate and reading rect feeders
+                        # of midas nodes on this machine (see ShmRing.py); the nodes' own buffers always use lsl
+k_profilerSignal = True  # profile for k_profileSeconds on SIGUSR1 / ctrl+break (see SamplingProfiler.py)
+
 # ---------------------------------------------
 # ---- Fake raw data (replace -999 (timestamp) microSsinceStart())
 # ---------------------------------------------
@@ -124,6 +137,29 @@ for c in ["marcotime"]:
 rawOutlet = lsl.StreamOutlet(rawStream_info, k_chunkSize, k_maxBuff)
 eventOutlet = lsl.StreamOutlet(eventStream_info, k_chunkSize, k_maxBuff)
 
+# same buffer duration as outlets
+rawRing = eventRing = None
+if k_sharedMemory:
+    rawRing = ShmRingWriter('SMI_Raw', k_nchans_raw, int(k_maxBuff * samplingRate))
+    eventRing = ShmRingWriter('SMI_Event', k_nchans_event, int(k_maxBuff * samplingRate))
+
+fixationFilter = FixationFilter()
+startOutlet = None
+if k_coalesceEvents and k_fixationStartStream:
+    startStream_info = lsl.StreamInfo('SMI_FixationStart', 'Event', k_nchans_event, samplingRate, 'float32', 'smifixstart500ds15')
+    startStream_info.desc().append_child_value("manufacturer", "SMI")
+    startChannels = startStream_info.desc().append_child("channels")
+    # same channels as event stream
+    for c in ["eye", "startTime", "endTime", "duration", "positionX", "positionY", "marcotime"]:
+        startChannels.append_child("channel")\
+            .append_child_value("label", c)\
+            .append_child_value("type", "Event")
+    startOutlet = lsl.StreamOutlet(startStream_info, k_chunkSize, k_maxBuff)
+
+# sample timestamps are in microseconds, events are irregular
+rawStats = OutletStats('SMI_Raw', rawOutlet, samplingRate, k_maxBuff, time_scale=1000000)
+eventStats = OutletStats('SMI_Event', eventOutlet, None, k_maxBuff)
+
 
 def FakeSample():
     while not stop:
@@ -144,6 +180,11 @@ def FakeSample():
         data[11] = fakeSamp[11]
         data[12] = fakeSamp[12]
         rawOutlet.push_sample(data)
+        if rawRing is not None:
+            rawRing.write(lsl.local_clock(), data)
+        rawStats.calls += 1
+        rawStats.pushed += 1
+        rawStats.last_time = data[0]
         
         time.sleep(0.002)  # note: minimum sleep on win seems to be 13ms
 
@@ -166,7 +207,15 @@ def FakeEvent():
         data[5] = fakeEv[5]
         data[6] = marcoTime()
 
-        eventOutlet.push_sample(data)
+        eventStats.calls += 1
+        kind = fixationFilter.classify(data) if k_coalesceEvents else END
+        if kind == START and startOutlet is not None:
+            startOutlet.push_sample(data)
+        if kind == END:
+            eventOutlet.push_sample(data)
+            if eventRing is not None:
+                eventRing.write(lsl.local_clock(), data)
+            eventStats.pushed += 1
         
         time.sleep(0.002)  # note: minimum sleep on win seems to be 13ms
 
@@ -177,10 +226,19 @@ sampleT = threading.Thread(target=FakeSample)
 sampleT.start()
 eventT = threading.Thread(target=FakeEvent)
 eventT.start()
+statsReporter = StatsReporter([rawStats, eventStats])
+statsReporter.start()
+
+profiler = SamplingProfiler('FakeStream')
+if k_profilerSignal:
+    install_signal(profiler)
 
 command = ''
 while not command == 'q':
-    command = raw_input('q = quit, l = send zeroes, f = send normal events: ')
+    command = raw_input('q = quit, l = send zeroes, f = send normal events, p = profile for ' + str(k_profileSeconds) + ' seconds: ')
+    if command=='p':
+        path = profiler.start()
+        print('Profiler already running' if path is None else 'Profiling, stacks will be written to ' + path)
     if command=='l':
         print('Sending zeroes in raw stream in 5 seconds...')
         time.sleep(5)
@@ -191,8 +249,14 @@ while not command == 'q':
         fake_raws = [fake_raw1, fake_raw2, fake_raw3, fake_raw4]
 
 stop = True
+statsReporter.stop()
 
 sampleT.join()
 eventT.join()
 
+# remove shared memory rings, so that nodes started later do not read stale ones
+for ring in (rawRing, eventRing):
+    if ring is not None:
+        ring.close()
+
 print('Terminating... ')
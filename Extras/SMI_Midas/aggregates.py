@@ -0,0 +1,136 @@
+""" Multi-resolution time aggregates of eye tracking channels, kept in shared memory.
+
+A feeder process adds samples as they arrive from lsl; responder processes of the
+node read them. Each level is a ring of fixed duration bins, storing per channel
+min, max, sum and count of valid samples (non zero, since SMI sends zeroes when
+an eye is lost) and the total count of samples.
+"""
+
+import multiprocessing as mp
+import numpy as np
+
+# (bin duration in seconds, number of bins kept)
+k_levels = [(0.01, 12000),  # 2 minutes
+            (0.1, 12000),  # 20 minutes
+            (1.0, 7200)]  # 2 hours
+
+# fields of each bin, per channel
+k_MIN, k_MAX, k_SUM, k_VALID, k_COUNT = range(5)
+k_nFields = 5
+
+
+class AggregatePyramid(object):
+    """ Aggregates of the given channels at all resolutions in k_levels. Must be created
+    before the processes that use it are started, so that they share its memory. """
+
+    def __init__(self, channels, levels=k_levels):
+        self.channels = list(channels)
+        self.levels = levels
+        self.lock = mp.Lock()
+        self._bin_ids = []
+        self._stats = []
+        self._shared = []
+        for _, n_bins in levels:
+            ids = mp.RawArray('q', n_bins)
+            stats = mp.RawArray('d', n_bins * len(self.channels) * k_nFields)
+            self._shared.append((ids, stats))
+        self._attach()
+        for bin_ids in self._bin_ids:
+            bin_ids[:] = -1
+
+    def _attach(self):
+        """ Numpy views of the shared arrays (re-created when unpickled in another process). """
+        self._bin_ids = []
+        self._stats = []
+        for (_, n_bins), (ids, stats) in zip(self.levels, self._shared):
+            self._bin_ids.append(np.frombuffer(ids, dtype=np.int64))
+            self._stats.append(np.frombuffer(stats, dtype=np.float64).reshape(n_bins, len(self.channels), k_nFields))
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_bin_ids'], state['_stats']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._attach()
+
+    def add(self, times, values):
+        """ Adds samples. times: n (seconds, increasing), values: n x len(channels). """
+        times = np.asarray(times, dtype=np.float64)
+        values = np.asarray(values, dtype=np.float64).reshape(len(times), len(self.channels))
+        if not len(times):
+            return
+        valid = values != 0
+        with self.lock:
+            for (res, n_bins), bin_ids, stats in zip(self.levels, self._bin_ids, self._stats):
+                ids = np.floor(times / res).astype(np.int64)
+                starts = np.flatnonzero(np.diff(ids, prepend=ids[0] - 1))
+                new_ids = ids[starts]
+                slots = new_ids % n_bins
+
+                # aggregates of this chunk for each bin it touches
+                v_min = np.minimum.reduceat(np.where(valid, values, np.inf), starts)
+                v_max = np.maximum.reduceat(np.where(valid, values, -np.inf), starts)
+                v_sum = np.add.reduceat(np.where(valid, values, 0.), starts)
+                v_valid = np.add.reduceat(valid.astype(np.float64), starts)
+                v_count = np.diff(np.append(starts, len(ids)))
+
+                # bins found in ring that belong to an older time are reset
+                stale = bin_ids[slots] != new_ids
+                stats[slots[stale]] = (np.inf, -np.inf, 0., 0., 0.)
+                bin_ids[slots] = new_ids
+
+                s = stats[slots]
+                s[:, :, k_MIN] = np.minimum(s[:, :, k_MIN], v_min)
+                s[:, :, k_MAX] = np.maximum(s[:, :, k_MAX], v_max)
+                s[:, :, k_SUM] += v_sum
+                s[:, :, k_VALID] += v_valid
+                s[:, :, k_COUNT] += v_count[:, None]
+                stats[slots] = s
+
+    def choose_level(self, start, resolution):
+        """ Coarsest level not coarser than resolution, unless it does not reach back to start
+        (then the finest level that does). """
+        level = 0
+        for i, (res, _) in enumerate(self.levels):
+            if res <= resolution:
+                level = i
+        for i in range(level, len(self.levels)):
+            res, n_bins = self.levels[i]
+            if self._bin_ids[i].max() - n_bins < np.floor(start / res):
+                return i
+        return len(self.levels) - 1
+
+    def query(self, channels, start, end, resolution):
+        """ Aggregates of channels in [start, end) (seconds, same clock as added times), at the coarsest
+        available resolution not larger than the requested one. Returns a dict of lists. """
+        level = self.choose_level(start, resolution)
+        res, n_bins = self.levels[level]
+        cols = [self.channels.index(c) for c in channels]
+        first, last = int(np.floor(start / res)), int(np.ceil(end / res))
+        with self.lock:
+            ids = np.arange(max(first, last - n_bins), last, dtype=np.int64)
+            slots = ids % n_bins
+            present = self._bin_ids[level][slots] == ids
+            stats = self._stats[level][slots[present]][:, cols]
+        ids = ids[present]
+        count = stats[:, :, k_COUNT]
+        valid = stats[:, :, k_VALID]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = np.where(valid > 0, stats[:, :, k_SUM] / valid, np.nan)
+            valid_fraction = valid / count
+        result = {'resolution': res, 'time': (ids * res).tolist()}
+        for i, c in enumerate(channels):
+            has_valid = valid[:, i] > 0
+            result[c] = {'min': _nan_list(np.where(has_valid, stats[:, i, k_MIN], np.nan)),
+                         'max': _nan_list(np.where(has_valid, stats[:, i, k_MAX], np.nan)),
+                         'mean': _nan_list(mean[:, i]),
+                         'count': count[:, i].astype(int).tolist(),
+                         'valid': valid_fraction[:, i].tolist()}
+        return result
+
+
+def _nan_list(a):
+    """ List with None instead of nan (for json). """
+    return [None if np.isnan(v) else v for v in a.tolist()]
@@ -1,15 +1,60 @@
 #!/usr/bin/env python3
 
+import os
 import sys
+import configparser
 
+import bottle
 from midas import utilities as mu
 from midas.dispatcher import Dispatcher
 
+from response_cache import ResponseCachePlugin
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'SMI_LSL'))
+from SamplingProfiler import SamplingProfiler, k_profileSeconds
+
+
+# ------------------------------------------------------------------------------
+# Dispatcher with a response cache
+# ------------------------------------------------------------------------------
+def node_ttls(config_file, dispatcher_section):
+    """ Cache time to live of each node's responses: one sampling interval of its primary channels. """
+    config = configparser.ConfigParser()
+    config.read(config_file)
+    ttls = {}
+    for section in config[dispatcher_section]['node_list'].split(','):
+        node = config[section.strip()]
+        ttls[node['node_name'].strip()] = 1.0 / float(node['primary_sampling_rate'])
+    return ttls
+
+
+class CachingDispatcher(Dispatcher):
+    """ Dispatcher which shares identical data / metric responses between clients, see response_cache.py.
+    GET /profile?seconds=N profiles the dispatcher process, see SMI_LSL/SamplingProfiler.py. """
+
+    cache_ttls = {}
+
+    def start(self):
+        plugin = ResponseCachePlugin(self.cache_ttls)
+        self.profiler = SamplingProfiler('dispatcher')
+        apps = [v for v in vars(self).values() if isinstance(v, bottle.Bottle)] or [bottle.default_app()]
+        for app in apps:
+            app.install(plugin)
+            app.route('/profile', 'GET', self.profile)
+        super().start()
+
+    def profile(self):
+        """ Starts profiling, returns the path of the collapsed stacks (null if already running). """
+        seconds = float(bottle.request.query.get('seconds', k_profileSeconds))
+        return {'path': self.profiler.start(seconds)}
+
 # ------------------------------------------------------------------------------
 # Run the dispatcher if started from the command line
 # ------------------------------------------------------------------------------
 if __name__ == "__main__":
-    dp = mu.midas_parse_config(Dispatcher, sys.argv)
+    if len(sys.argv) > 2:
+        CachingDispatcher.cache_ttls = node_ttls(sys.argv[1], sys.argv[2])
+    dp = mu.midas_parse_config(CachingDispatcher, sys.argv)
     if dp is not None:
         dp.start()
 # ------------------------------------------------------------------------------
@@ -1,9 +1,31 @@
 #!/usr/bin/env python3
 
+import os
 import sys
+import time
+import threading
+import multiprocessing as mp
+import numpy as np
+import pylsl as lsl
 from midas.node import BaseNode
 from midas import utilities as mu
 
+from aggregates import AggregatePyramid
+from reading_rects import ReadingRects
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'SMI_LSL'))
+from ShmRing import ShmRingReader
+from SamplingProfiler import SamplingProfiler, k_profileSeconds, k_profileDir
+
+k_pollInterval = 0.01  # seconds between reads of the shared memory ring
+k_ringRetry = 5.  # seconds between looks for a (new) shared memory ring while reading from lsl
+
+_profiler = None  # per process, created when first needed
+_watcher_pid = None  # process in which the profile request watcher runs
+
+# raw stream channels for which multi-resolution aggregates are kept
+k_aggregateChannels = ['leftDiam', 'leftEyePositionZ', 'rightDiam', 'rightEyePositionZ']
+
 
 # ------------------------------------------------------------------------------
 # Create a Node
@@ -15,6 +37,157 @@ class NodeExampleA(BaseNode):
         """ Initialize example node. """
         super().__init__(*args)
 
+        # profile metric: end time (unix seconds) of the requested profiling, and a condition waking up
+        # a watcher thread in every process of the node (receiver, responders, feeders)
+        self.profile_until = mp.RawValue('d', 0.)
+        self.profile_request = mp.Condition()
+        self.metric_functions.append(self.profile)
+        self.generate_metric_lists()
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=self.watch_profile_requests)
+
+        # raw stream keeps aggregates at 10ms, 100ms and 1s, see aggregates.py
+        self.aggregates = None
+        if self.lsl_stream_name == 'SMI_Raw':
+            self.aggregates = AggregatePyramid(k_aggregateChannels)
+            self.metric_functions.append(self.aggregate)
+            self.generate_metric_lists()
+
+        # event stream accumulates fixation dwell times on rects sent by the client, see reading_rects.py
+        self.reading_rects = None
+        if self.lsl_stream_name == 'SMI_Event':
+            self.reading_rects = ReadingRects()
+            self.metric_functions.append(self.set_geometry)
+            self.metric_functions.append(self.changed_rects)
+            self.generate_metric_lists()
+
+    def aggregate(self, x, seconds_ago, resolution, *channels):
+        """ Min, max, mean, sample count and valid fraction of channels over the last
+        seconds_ago seconds, using the coarsest stored resolution not larger than the one requested. """
+        now = lsl.local_clock()
+        return self.aggregates.query(channels or k_aggregateChannels, now - seconds_ago, now, resolution)
+
+    def set_geometry(self, x, geometry):
+        """ Sets the visible pages and the rects (lines or paragraphs) to accumulate dwell times on.
+        Returns the cursor to pass to changed_rects. """
+        return self.reading_rects.set_geometry(geometry)
+
+    def changed_rects(self, x, cursor):
+        """ Rects whose dwell time changed since cursor, and the next cursor. """
+        return self.reading_rects.changed_since(cursor)
+
+    def profile(self, x, seconds=k_profileSeconds):
+        """ Profiles all processes of this node for seconds, see SMI_LSL/SamplingProfiler.py.
+        Each process writes its own collapsed stacks file; returns the folder they are written to. """
+        self.profile_until.value = time.time() + seconds
+        with self.profile_request:
+            self.profile_request.notify_all()
+        return {'folder': k_profileDir}
+
+    def watch_profile_requests(self):
+        """ Starts a thread profiling the current process whenever the profile metric is called.
+        The thread only waits on profile_request in between, so it costs nothing. Called once per
+        process: in start() for the main process, after fork or when unpickled for the others. """
+        global _watcher_pid
+        if _watcher_pid == os.getpid():
+            return
+        _watcher_pid = os.getpid()
+
+        def watch():
+            global _profiler
+            while True:
+                with self.profile_request:
+                    self.profile_request.wait()
+                remaining = self.profile_until.value - time.time()
+                if remaining > 0:
+                    if _profiler is None:
+                        # created here, since right after fork the process does not have its name yet
+                        _profiler = SamplingProfiler('{}_{}'.format(self.lsl_stream_name, mp.current_process().name))
+                    _profiler.start(remaining)
+
+        thread = threading.Thread(target=watch, name='profile_watcher')
+        thread.daemon = True
+        thread.start()
+
+    def __setstate__(self, state):
+        # processes started with spawn (windows, macos) receive the node pickled
+        parent = getattr(super(), '__setstate__', None)
+        if parent is not None:
+            parent(state)
+        else:
+            self.__dict__.update(state)
+        self.watch_profile_requests()
+
+    def open_ring(self):
+        """ Reader of the shared memory ring of the node's stream, None if there is none with a live writer. """
+        try:
+            ring = ShmRingReader(self.lsl_stream_name)
+        except (IOError, OSError, ValueError):
+            return None
+        if ring.stale():
+            ring.close()
+            return None
+        return ring
+
+    def read_stream(self, handle):
+        """ Calls handle(times, values) with new samples of the node's stream, forever.
+        Uses the shared memory ring written by DataStreaming.py / FakeStream.py if they run on
+        this machine with k_sharedMemory on, otherwise (or while its writer is gone) a separate lsl inlet. While on
+        lsl, looks for a ring every k_ringRetry seconds, so that a restarted writer is picked up. """
+        ring = self.open_ring()
+        inlet = None
+        next_retry = 0
+        while True:
+            if ring is not None:
+                times, values = ring.read()
+                if len(times):
+                    handle(times, values)
+                elif ring.stale():
+                    print('Writer of the {} shared memory ring is gone, switching to lsl'.format(self.lsl_stream_name))
+                    ring.close()
+                    ring = None
+                    next_retry = time.time() + k_ringRetry
+                    continue
+                time.sleep(k_pollInterval)
+                continue
+
+            if time.time() >= next_retry:
+                ring = self.open_ring()
+                next_retry = time.time() + k_ringRetry
+                if ring is not None:
+                    print('Reading {} from shared memory ring again'.format(self.lsl_stream_name))
+                    if inlet is not None:
+                        inlet.close_stream()
+                        inlet = None
+                    continue
+            if inlet is None:
+                found = lsl.resolve_byprop('name', self.lsl_stream_name, timeout=k_ringRetry)
+                if not found:
+                    continue
+                inlet = lsl.StreamInlet(found[0])
+            chunk, times = inlet.pull_chunk(timeout=1.0)
+            if times:
+                offset = inlet.time_correction()
+                handle([t + offset for t in times], chunk)
+
+    def feed_aggregates(self):
+        """ Reads the raw stream into the aggregates. Runs in its own process. """
+        names = [c.strip() for c in self.primary_channel_names]
+        cols = [names.index(c) for c in k_aggregateChannels]
+        self.read_stream(lambda times, values: self.aggregates.add(times, np.asarray(values)[:, cols]))
+
+    def feed_reading_rects(self):
+        """ Reads fixations from the event stream into the reading rects. Runs in its own process. """
+        self.read_stream(lambda times, values: self.reading_rects.add_fixations(values))
+
+    def start(self):
+        self.watch_profile_requests()
+        if self.aggregates is not None:
+            mp.Process(target=self.feed_aggregates, daemon=True).start()
+        if self.reading_rects is not None:
+            mp.Process(target=self.feed_reading_rects, daemon=True).start()
+        super().start()
+
 # ------------------------------------------------------------------------------
 # Run the node if started from the command line
 # ------------------------------------------------------------------------------
@@ -0,0 +1,129 @@
+""" Streaming accumulation of fixation dwell time on text rects (lines or paragraphs), kept in shared memory.
+
+The client (PeyeDF) sends the geometry of what is on screen: for each visible page its
+frame in screen pixels (same coordinates as SMI fixations, origin at the top left) and
+its size in page points, plus the rects to track in page points (origin at the bottom
+left, as in reading rects). Fixations from the event stream are mapped onto these
+rects and their durations summed. Every change bumps a counter, so that clients can
+ask only for rects that changed since the last counter they saw.
+"""
+
+import multiprocessing as mp
+import time
+import numpy as np
+
+k_maxRects = 4096  # rects that can be tracked at the same time
+k_maxPages = 32  # visible pages at the same time
+k_readClass = 20  # ReadingClass.low ("read")
+k_eyeSource = 3  # ClassSource.eye
+
+# event stream channels
+k_EYE, k_START, k_END, k_DURATION, k_X, k_Y, k_MARCOTIME = range(7)
+
+
+class ReadingRects(object):
+    """ Must be created before the processes that use it are started, so that they share its memory. """
+
+    def __init__(self):
+        self.lock = mp.Lock()
+        self._shared = {'rects': mp.RawArray('d', k_maxRects * 5),  # pageIndex, x, y, width, height
+                        'dwell': mp.RawArray('d', k_maxRects),  # milliseconds
+                        'unixt': mp.RawArray('q', k_maxRects),  # last fixation time (unix ms)
+                        'version': mp.RawArray('q', k_maxRects),  # value of counter when last changed
+                        'pages': mp.RawArray('d', k_maxPages * 7),  # pageIndex, screen x, y, width, height, page width, height
+                        'counts': mp.RawArray('q', 3)}  # n rects, n pages, change counter
+        self._attach()
+
+    def _attach(self):
+        """ Numpy views of the shared arrays (re-created when unpickled in another process). """
+        s = self._shared
+        self.rects = np.frombuffer(s['rects'], dtype=np.float64).reshape(k_maxRects, 5)
+        self.dwell = np.frombuffer(s['dwell'], dtype=np.float64)
+        self.unixt = np.frombuffer(s['unixt'], dtype=np.int64)
+        self.version = np.frombuffer(s['version'], dtype=np.int64)
+        self.pages = np.frombuffer(s['pages'], dtype=np.float64).reshape(k_maxPages, 7)
+        self.counts = np.frombuffer(s['counts'], dtype=np.int64)
+
+    def __getstate__(self):
+        return {'lock': self.lock, '_shared': self._shared}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._attach()
+
+    def set_geometry(self, geometry):
+        """ geometry: {"pages": [{"pageIndex", "frame": [x, y, w, h] (screen pixels), "size": [w, h] (points)}],
+        "rects": [{"pageIndex", "origin": {"x", "y"}, "size": {"width", "height"}}]}
+        Either key can be omitted to keep the current value. If rects are given, they replace the
+        tracked rects and dwell times restart from zero; send only pages (e.g. after scrolling) to
+        keep accumulating on the same rects. Returns the current counter. """
+        pages = geometry.get('pages')
+        rects = geometry.get('rects')
+        with self.lock:
+            if pages is not None:
+                pages = pages[:k_maxPages]
+                for i, p in enumerate(pages):
+                    self.pages[i] = [p['pageIndex']] + list(p['frame']) + list(p['size'])
+                self.counts[1] = len(pages)
+            if rects is not None:
+                rects = rects[:k_maxRects]
+                for i, r in enumerate(rects):
+                    self.rects[i] = (r['pageIndex'], r['origin']['x'], r['origin']['y'], r['size']['width'], r['size']['height'])
+                self.dwell[:len(rects)] = 0.
+                self.unixt[:len(rects)] = 0
+                self.version[:len(rects)] = 0
+                self.counts[0] = len(rects)
+            return int(self.counts[2])
+
+    def add_fixations(self, events):
+        """ Adds completed fixations (rows of the event stream) to the rects they fall on. """
+        events = np.asarray(events, dtype=np.float64).reshape(-1, 7)
+        events = events[(events[:, k_END] != 0) & (events[:, k_DURATION] > 0)]
+        if not len(events):
+            return
+        with self.lock:
+            n_rects, n_pages = int(self.counts[0]), int(self.counts[1])
+            if not n_rects or not n_pages:
+                return
+            pages = self.pages[:n_pages]
+            sx, sy = events[:, k_X], events[:, k_Y]
+            # visible page each fixation is on (fixations outside all pages are dropped)
+            on_page = ((sx[:, None] >= pages[:, 1]) & (sx[:, None] < pages[:, 1] + pages[:, 3]) &
+                       (sy[:, None] >= pages[:, 2]) & (sy[:, None] < pages[:, 2] + pages[:, 4]))
+            hit = on_page.any(axis=1)
+            if not hit.any():
+                return
+            p = pages[on_page[hit].argmax(axis=1)]
+            # screen pixels (top left origin) -> page points (bottom left origin)
+            px = (sx[hit] - p[:, 1]) / p[:, 3] * p[:, 5]
+            py = p[:, 6] - (sy[hit] - p[:, 2]) / p[:, 4] * p[:, 6]
+            duration = events[hit, k_DURATION] / 1000.  # microseconds -> milliseconds
+
+            rects = self.rects[:n_rects]
+            inside = ((p[:, 0][:, None] == rects[:, 0]) &
+                      (px[:, None] >= rects[:, 1]) & (px[:, None] <= rects[:, 1] + rects[:, 3]) &
+                      (py[:, None] >= rects[:, 2]) & (py[:, None] <= rects[:, 2] + rects[:, 4]))
+            added = inside.T.astype(np.float64) @ duration
+            changed = np.flatnonzero(added)
+            if len(changed):
+                self.counts[2] += 1
+                self.dwell[changed] += added[changed]
+                self.unixt[changed] = int(round(time.time() * 1000))
+                self.version[changed] = self.counts[2]
+
+    def changed_since(self, cursor):
+        """ Rects whose dwell changed after counter value cursor, in the reading rect json layout
+        (with an additional dwell field, in milliseconds), and the new counter. """
+        with self.lock:
+            n_rects = int(self.counts[0])
+            changed = np.flatnonzero(self.version[:n_rects] > cursor)
+            rects, dwell, unixt = self.rects[changed].copy(), self.dwell[changed].copy(), self.unixt[changed].copy()
+            counter = int(self.counts[2])
+        return {'cursor': counter,
+                'rects': [{'pageIndex': int(r[0]),
+                           'origin': {'x': r[1], 'y': r[2]},
+                           'size': {'width': r[3], 'height': r[4]},
+                           'readingClass': k_readClass,
+                           'classSource': k_eyeSource,
+                           'unixt': [int(t)],
+                           'dwell': d} for r, d, t in zip(rects.tolist(), dwell.tolist(), unixt.tolist())]}
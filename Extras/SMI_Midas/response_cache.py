@@ -0,0 +1,121 @@
+""" Short lived cache of encoded dispatcher responses, shared by all clients.
+
+Identical data / metric requests (after normalising their json) made within a
+node's sampling interval get the same response. Concurrent identical requests
+wait for the first one to be computed instead of computing it again.
+"""
+
+import json
+import threading
+import time
+from collections import OrderedDict
+
+import bottle
+
+k_maxBytes = 32 * 1024 * 1024  # memory cap for cached responses
+k_cachedTypes = ('data', 'metric')  # request types that are cached
+
+
+class ResponseCache(object):
+    """ LRU cache of bytes with per entry expiry and coalescing of concurrent computations. """
+
+    def __init__(self, max_bytes=k_maxBytes):
+        self.max_bytes = max_bytes
+        self.n_bytes = 0
+        self.entries = OrderedDict()  # key -> (expiry, value, content type)
+        self.in_flight = {}  # key -> threading.Event
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, ttl, compute):
+        """ Cached (value, content type) for key, or the result of compute() which is cached for ttl seconds.
+        compute returns (value, content type, cacheable). """
+        while True:
+            with self.lock:
+                entry = self.entries.get(key)
+                if entry is not None and entry[0] > time.time():
+                    self.entries.move_to_end(key)
+                    self.hits += 1
+                    return entry[1], entry[2]
+                waiting = self.in_flight.get(key)
+                if waiting is None:
+                    done = self.in_flight[key] = threading.Event()
+                    self.misses += 1
+                    break
+            waiting.wait()
+
+        try:
+            value, content_type, cacheable = compute()
+            if cacheable:
+                self._put(key, time.time() + ttl, value, content_type)
+            return value, content_type
+        finally:
+            with self.lock:
+                del self.in_flight[key]
+            done.set()
+
+    def _put(self, key, expiry, value, content_type):
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.n_bytes -= len(old[1])
+            if len(value) > self.max_bytes:
+                return
+            self.entries[key] = (expiry, value, content_type)
+            self.n_bytes += len(value)
+            now = time.time()
+            # drop expired entries first, then least recently used ones
+            for k in [k for k, e in self.entries.items() if e[0] <= now]:
+                self.n_bytes -= len(self.entries.pop(k)[1])
+            while self.n_bytes > self.max_bytes:
+                _, e = self.entries.popitem(last=False)
+                self.n_bytes -= len(e[1])
+
+
+def normalise_path(path):
+    """ (node, request type, request with sorted json keys), or None if the path is not cacheable. """
+    parts = path.strip('/').split('/', 2)
+    if len(parts) != 3 or parts[1] not in k_cachedTypes:
+        return None
+    node, request_type, request = parts
+    try:
+        request = json.dumps(json.loads(request), sort_keys=True, separators=(',', ':'))
+    except ValueError:
+        pass
+    return node, request_type, request
+
+
+class ResponseCachePlugin(object):
+    """ Bottle plugin caching GET responses of data and metric requests. ttls: node name -> seconds. """
+    name = 'response_cache'
+    api = 2
+
+    def __init__(self, ttls, cache=None):
+        self.ttls = ttls
+        self.cache = cache or ResponseCache()
+
+    def apply(self, callback, route):
+        def wrapper(*args, **kwargs):
+            request = bottle.request
+            key = normalise_path(request.path) if request.method == 'GET' else None
+            if key is None or key[0] not in self.ttls:
+                return callback(*args, **kwargs)
+
+            def compute():
+                result = callback(*args, **kwargs)
+                if isinstance(result, dict):
+                    result = json.dumps(result)
+                    bottle.response.content_type = 'application/json'
+                if isinstance(result, str):
+                    result = result.encode('utf-8')
+                if not isinstance(result, bytes):
+                    # e.g. generators or files, not cached
+                    return result, bottle.response.content_type, False
+                return result, bottle.response.content_type, bottle.response.status_code == 200
+
+            value, content_type = self.cache.get(key, self.ttls[key[0]], compute)
+            bottle.response.content_type = content_type
+            return value
+
+        return wrapper